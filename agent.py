@@ -1,44 +1,140 @@
+import contextlib
 import random
-from collections import deque
 
 import numpy as np
 import torch
 
-from neural import MarioNet
+from checkpoint import Checkpointer
+from memory import (
+    BatchPrefetcher,
+    FrameReplayBuffer,
+    NStepAccumulator,
+    PrioritizedReplay,
+    build_replay,
+)
+from metrics import PhaseTimer
+from neural import CompiledPolicy, MarioNet, TargetUpdate
 
 
 class Mario:
-    def __init__(self, state_dim, action_dim, save_dir=None, checkpoint=None):
+    def __init__(
+        self,
+        state_dim,
+        action_dim,
+        save_dir=None,
+        checkpoint=None,
+        replay="array",
+        replay_capacity=100000,
+        prioritized=False,
+        checkpoint_replay=False,
+        keep_checkpoints=5,
+        timer=None,
+        n_steps=1,
+        compile_act=None,
+        compile_every=100,
+        tau=1.0,
+        fused_update=None,
+        mixed_precision=None,
+        prefetch=0,
+    ):
         self.state_dim = state_dim
         self.action_dim = action_dim
-        self.memory = deque(maxlen=100000)
         self.batch_size = 32
 
         self.exploration_rate = 1
         self.exploration_rate_decay = 0.99999975
         self.exploration_rate_min = 0.1
         self.gamma = 0.9
+        self.n_steps = n_steps  # no. of rewards summed before bootstrapping from Q_target
 
         self.curr_step = 0
+        self.last_learn_step = 0  # curr_step at the previous learn() call
         self.burnin = 1e5  # min. experiences before training
         self.learn_every = 3  # no. of experiences between updates to Q_online
         self.sync_every = 1e4  # no. of experiences between Q_target & Q_online sync
+        # With tau < 1, Q_target instead moves tau of the way to Q_online after every update
+        self.tau = tau
+
+        # Wall time of the phases inside learn(); the training loop times its own with it
+        self.timer = timer if timer is not None else PhaseTimer()
 
         self.save_every = 5e5  # no. of experiences between saving Mario Net
         self.save_dir = save_dir
+        self.checkpoint_replay = checkpoint_replay  # also snapshot the replay into checkpoints
+        # Checkpoints are written in the background, keeping the newest keep_checkpoints
+        self.checkpointer = (
+            Checkpointer(save_dir, keep_last=keep_checkpoints) if save_dir is not None else None
+        )
 
         self.use_cuda = torch.cuda.is_available()
         self.device = torch.device("cuda" if self.use_cuda else "cpu")
+        # "array" stores whole (state, next_state) stacks, "frames" stores each frame once;
+        # the "memmap" variants keep them on disk under save_dir and survive restarts
+        self.memory = build_replay(
+            replay,
+            replay_capacity,
+            self.state_dim,
+            device=self.device,
+            directory=self.save_dir / "replay" if self.save_dir is not None else None,
+        )
+        if isinstance(self.memory, FrameReplayBuffer) and n_steps > self.memory.history:
+            raise ValueError(f"Frame replay supports n_steps up to {self.memory.history}")
+        # Sample by TD error instead of uniformly, weighting updates to stay unbiased
+        self.prioritized = prioritized
+        if self.prioritized:
+            self.memory = PrioritizedReplay(self.memory)
+        # With prefetch > 0 a background thread keeps that many batches ready for update();
+        # every access to the replay from this thread then holds memory_lock
+        self.prefetcher = None
+        self.memory_lock = contextlib.nullcontext()
+        if prefetch:
+            self.prefetcher = BatchPrefetcher(self.memory, self.batch_size, prefetch, prioritized)
+            self.memory_lock = self.prefetcher.lock
+        # cache() folds the rewards of the next n_steps steps into each transition
+        self.n_step = NStepAccumulator(self.n_steps, self.gamma)
         # Mario's DNN to predict the most optimal action - we implement this in the Learn section
         self.net = MarioNet(self.state_dim, self.action_dim, device=self.device).float()
         if self.use_cuda:
             self.net = self.net.to(self.device)
+
+        self.target_update = TargetUpdate(self.net.online, self.net.target)
+
+        # MarioNet forwards run under bfloat16 autocast, those of learn() with "learn" and
+        # also those of act() with "all"; weights and optimizer state stay float32
+        if mixed_precision not in (None, "learn", "all"):
+            raise ValueError(f"Unknown mixed precision {mixed_precision!r}, expected learn/all")
+        self.mixed_precision = mixed_precision
+
+        self.optimizer = torch.optim.Adam(self.net.parameters(), lr=0.00025)
+        self.loss_fn = torch.nn.SmoothL1Loss(reduction="none")
+        # One Q_online forward over state and next_state together instead of two. It saves
+        # kernel launches but backpropagates through twice the rows, so by default only on GPU
+        self.fused_update = self.use_cuda if fused_update is None else fused_update
+        # act() can go through a traced ("trace") or torch.compile'd ("compile") copy of
+        # Q_online; a traced one is rebuilt every compile_every updates
+        self.policy = (
+            CompiledPolicy(self.net.online, compile_act, rebuild_every=compile_every)
+            if compile_act
+            else None
+        )
+
         if checkpoint:
             self.load(checkpoint)
 
-        self.optimizer = torch.optim.Adam(self.net.parameters(), lr=0.00025)
-        self.loss_fn = torch.nn.SmoothL1Loss()
+    def to_tensor(self, state):
+        """
+        Observations as a tensor on `self.device`. uint8 frames stay uint8 and are
+        scaled by MarioNet; [0, 1] float frames become float32.
+        """
+        state = torch.as_tensor(np.asarray(state), device=self.device)
+        return state if state.dtype == torch.uint8 else state.float()
 
+    def autocast(self, act=False):
+        """bfloat16 autocast for the MarioNet forwards of learn() (or act()), else a no-op"""
+        enabled = self.mixed_precision == "all" or (self.mixed_precision == "learn" and not act)
+        return torch.autocast(self.device.type, dtype=torch.bfloat16, enabled=enabled)
+
+    @torch.no_grad()
     def act(self, state):
         """
         Given a state, choose an epsilon-greedy action and update value of step.
@@ -54,15 +150,13 @@ class Mario:
 
         # EXPLOIT
         else:
-            state = np.array(state)
-            state = (
-                torch.FloatTensor(state).cuda()
-                if self.use_cuda
-                else torch.FloatTensor(state)
-            )
-            state = state.unsqueeze(0)
-            action_values = self.net(state, model="online")
-            action_idx = torch.argmax(action_values, axis=1).item()
+            state = self.to_tensor(state).unsqueeze(0)
+            if self.policy is not None:
+                action_idx = self.policy(state).item()
+            else:
+                with self.autocast(act=True):
+                    action_values = self.net(state, model="online")
+                action_idx = torch.argmax(action_values, axis=1).item()
 
         # decrease exploration_rate
         self.exploration_rate *= self.exploration_rate_decay
@@ -72,7 +166,44 @@ class Mario:
         self.curr_step += 1
         return action_idx
 
-    def cache(self, state, next_state, action, reward, done):
+    @torch.no_grad()
+    def act_batch(self, states):
+        """
+        Choose an epsilon-greedy action for each of a batch of states.
+
+        Inputs:
+        states (np.ndarray): A batch of observations, dimension is (N, *state_dim)
+        Outputs:
+        action_idx (np.ndarray): One action per state
+        """
+        states = np.asarray(states)
+        n = len(states)
+
+        # Row i sees the rate that i sequential act() calls would have decayed to
+        exploration_rates = np.maximum(
+            self.exploration_rate * self.exploration_rate_decay ** np.arange(n),
+            self.exploration_rate_min,
+        )
+        # EXPLORE
+        action_idx = np.random.randint(self.action_dim, size=n)
+
+        # EXPLOIT, with one forward pass over the rows that do
+        exploit = np.flatnonzero(np.random.rand(n) >= exploration_rates)
+        if len(exploit) > 0:
+            state = self.to_tensor(states[exploit])
+            with self.autocast(act=True):
+                action_values = self.net(state, model="online")
+            action_idx[exploit] = torch.argmax(action_values, axis=1).cpu().numpy()
+
+        # decrease exploration_rate
+        self.exploration_rate *= self.exploration_rate_decay**n
+        self.exploration_rate = max(self.exploration_rate_min, self.exploration_rate)
+
+        # increment step
+        self.curr_step += n
+        return action_idx
+
+    def cache(self, state, next_state, action, reward, done, stream=0):
         """
         Store the experience to self.memory (replay buffer)
 
@@ -81,120 +212,220 @@ class Mario:
         next_state (LazyFrame),
         action (int),
         reward (float),
-        done(bool))
-        """
-        state = np.array(state)
-        next_state = np.array(next_state)
-        state = (
-            torch.FloatTensor(state).cuda()
-            if self.use_cuda
-            else torch.FloatTensor(state)
-        )
-        next_state = (
-            torch.FloatTensor(next_state).cuda()
-            if self.use_cuda
-            else torch.FloatTensor(next_state)
-        )
-        action = (
-            torch.LongTensor([action]).cuda()
-            if self.use_cuda
-            else torch.LongTensor([action])
-        )
-        reward = (
-            torch.DoubleTensor([reward]).cuda()
-            if self.use_cuda
-            else torch.DoubleTensor([reward])
-        )
-        done = (
-            torch.BoolTensor([done]).cuda()
-            if self.use_cuda
-            else torch.BoolTensor([done])
-        )
-
-        self.memory.append((state, next_state, action, reward, done))
+        done(bool),
+        stream (int): Which environment the experience comes from, for vectorized envs
+        """
+        transitions = self.n_step.push(state, next_state, action, reward, done, stream)
+        with self.memory_lock:
+            for transition in transitions:
+                self.memory.add(*transition, stream=stream)
 
     def recall(self):
         """
         Retrieve a batch of experiences from memory
+
+        Outputs:
+        batch (tuple): (state, next_state, action, reward, done, steps), where `reward`
+        is the discounted return of an n-step transition and `steps` the no. of env
+        steps it spans, so the bootstrap from `next_state` is discounted by gamma ** steps
         """
-        batch = random.sample(self.memory, self.batch_size)
-        state, next_state, action, reward, done = map(torch.stack, zip(*batch))
-        return state, next_state, action.squeeze(), reward.squeeze(), done.squeeze()
+        return self.memory.sample(self.batch_size)
 
     def td_estimate(self, state, action):
-        current_Q = self.net(state, model="online")[
-            np.arange(0, self.batch_size), action
-        ]  # Q_online(s,a)
+        current_Q = (
+            self.net(state, model="online").gather(1, action.unsqueeze(1)).squeeze(1)
+        )  # Q_online(s,a)
         return current_Q
 
     @torch.no_grad()
-    def td_target(self, reward, next_state, done):
+    def td_target(self, reward, next_state, done, steps=None):
+        """
+        Double DQN target of n-step transitions: `reward` is the discounted return of
+        the `steps` steps to `next_state`, so the bootstrap is discounted by
+        gamma ** steps (one step if `steps` is None)
+        """
         next_state_Q = self.net(next_state, model="online")
         best_action = torch.argmax(next_state_Q, axis=1)
-        next_Q = self.net(next_state, model="target")[
-            np.arange(0, self.batch_size), best_action
-        ]
-        return (reward + (1 - done.float()) * self.gamma * next_Q).float()
+        next_Q = (
+            self.net(next_state, model="target").gather(1, best_action.unsqueeze(1)).squeeze(1)
+        )
+        discount = self.gamma if steps is None else self.gamma ** steps.float()
+        return (reward + (1 - done.float()) * discount * next_Q).float()
 
-    def update_Q_online(self, td_estimate, td_target):
+    def td_fused(self, state, next_state, action, reward, done, steps=None):
+        """
+        TD estimate and double DQN target from one Q_online forward over `state` and
+        `next_state` concatenated and one Q_target forward. The `next_state` half only
+        picks the bootstrap action, so it is detached and adds no gradient.
+        """
+        n = len(state)
+        online_Q = self.net(torch.cat((state, next_state)), model="online")
+        current_Q = online_Q[:n].gather(1, action.unsqueeze(1)).squeeze(1)  # Q_online(s,a)
+        best_action = online_Q[n:].detach().argmax(1, keepdim=True)
+        with torch.no_grad():
+            next_Q = self.net(next_state, model="target").gather(1, best_action).squeeze(1)
+            discount = self.gamma if steps is None else self.gamma ** steps.float()
+            td_target = (reward + (1 - done.float()) * discount * next_Q).float()
+        return current_Q, td_target
+
+    def update_Q_online(self, td_estimate, td_target, weights=None):
         loss = self.loss_fn(td_estimate, td_target)
-        self.optimizer.zero_grad()
-        loss.backward()
-        self.optimizer.step()
+        if weights is not None:
+            loss = loss * weights  # importance-sampling correction for prioritized replay
+        loss = loss.mean()
+        with self.timer.phase("backward"):
+            self.optimizer.zero_grad()
+            loss.backward()
+        with self.timer.phase("optimizer"):
+            self.optimizer.step()
+        if self.policy is not None:
+            self.policy.updated()
         return loss.item()
 
-    def sync_Q_target(self):
-        self.net.target.load_state_dict(self.net.online.state_dict())
+    def sync_Q_target(self, tau=1.0):
+        self.target_update(tau)
+
+    def crossed(self, every, last_step):
+        """No. of multiples of `every` passed since `last_step`"""
+        return int(self.curr_step // every - last_step // every)
+
+    def burned_in(self):
+        """Whether the replay holds enough experiences to train; a replay smaller than
+        `burnin` only has to be full"""
+        return len(self.memory) >= min(self.burnin, self.memory.capacity)
 
     def learn(self):
-        if self.curr_step % self.sync_every == 0:
-            self.sync_Q_target()
+        # With vectorized envs act_batch() advances several steps between calls,
+        # so schedules fire when a multiple is crossed rather than hit exactly
+        last_step, self.last_learn_step = self.last_learn_step, self.curr_step
+
+        if self.tau >= 1 and self.crossed(self.sync_every, last_step):
+            with self.timer.phase("sync"):
+                self.sync_Q_target()
 
-        if self.curr_step % self.save_every == 0:
-            self.save()
+        if self.crossed(self.save_every, last_step):
+            with self.timer.phase("save"):
+                self.save()
 
-        if self.curr_step < self.burnin:
+        if not self.burned_in():
             return None, None
 
-        if self.curr_step % self.learn_every != 0:
+        updates = self.crossed(self.learn_every, last_step)
+        if updates == 0:
             return None, None
 
-        # Sample from memory
-        state, next_state, action, reward, done = self.recall()
+        for _ in range(updates):
+            q, loss = self.update()
+        return q, loss
 
-        # Get TD Estimate
-        td_est = self.td_estimate(state, action)
+    def update(self):
+        """
+        One gradient step on a sampled batch.
 
-        # Get TD Target
-        td_tgt = self.td_target(reward, next_state, done)
+        Outputs:
+        q (float): Mean TD estimate of the batch
+        loss (float): Loss of the batch
+        """
+        # Sample from memory
+        with self.timer.phase("sample"):
+            if self.prefetcher is not None:
+                batch, indices, weights, sampled_at = self.prefetcher.get()
+                state, next_state, action, reward, done, steps = batch
+            elif self.prioritized:
+                batch, indices, weights = self.memory.sample_prioritized(self.batch_size)
+                state, next_state, action, reward, done, steps = batch
+            else:
+                state, next_state, action, reward, done, steps = self.recall()
+                weights = None
+
+        with self.timer.phase("forward"), self.autocast():
+            if self.fused_update:
+                td_est, td_tgt = self.td_fused(state, next_state, action, reward, done, steps)
+            else:
+                # Get TD Estimate
+                td_est = self.td_estimate(state, action)
+
+                # Get TD Target
+                td_tgt = self.td_target(reward, next_state, done, steps)
+
+        # The loss and the backward pass run outside autocast, in float32
+        td_est = td_est.float()
 
         # Backpropagate loss through Q_online
-        loss = self.update_Q_online(td_est, td_tgt)
+        loss = self.update_Q_online(td_est, td_tgt, weights)
+
+        if self.tau < 1:
+            with self.timer.phase("sync"):
+                self.sync_Q_target(self.tau)
+
+        if self.prioritized:
+            td_error = (td_est.detach() - td_tgt).abs().cpu().numpy()
+            if self.prefetcher is not None:
+                # The batch may predate writes to its slots; those keep their priority
+                self.prefetcher.update_priorities(indices, td_error, sampled_at)
+            else:
+                self.memory.update_priorities(indices, td_error)
 
         return (td_est.mean().item(), loss)
 
+    def state_dict(self):
+        """Everything needed to resume training, by reference"""
+        state = dict(
+            model=self.net.state_dict(),
+            exploration_rate=self.exploration_rate,
+            optimizer=self.optimizer.state_dict(),
+            curr_step=self.curr_step,
+            last_learn_step=self.last_learn_step,
+            rng=dict(
+                python=random.getstate(),
+                numpy=np.random.get_state(),
+                torch=torch.get_rng_state(),
+                cuda=torch.cuda.get_rng_state_all() if self.use_cuda else None,
+            ),
+        )
+        if self.checkpoint_replay:
+            state["replay"] = self.memory.state_dict()
+        return state
+
     def save(self):
         if self.save_dir is not None:
             save_path = (
                 self.save_dir
                 / f"mario_net_{int(self.curr_step // self.save_every)}.chkpt"
             )
-            torch.save(
-                dict(
-                    model=self.net.state_dict(), exploration_rate=self.exploration_rate
-                ),
-                save_path,
-            )
-            print(f"MarioNet saved to {save_path} at step {self.curr_step}")
+            # Only the snapshot happens here; the file is written in the background
+            with self.memory_lock:  # the prefetcher must not change the replay mid-copy
+                self.checkpointer.save(self.state_dict(), save_path)
 
     def load(self, load_path):
         if not load_path.exists():
             raise ValueError(f"{load_path} does not exist")
 
-        ckp = torch.load(load_path, map_location=("cuda" if self.use_cuda else "cpu"))
+        ckp = torch.load(
+            load_path, map_location=("cuda" if self.use_cuda else "cpu"), weights_only=False
+        )
         exploration_rate = ckp.get("exploration_rate")
         state_dict = ckp.get("model")
 
         print(f"Loading model at {load_path} with exploration rate {exploration_rate}")
         self.net.load_state_dict(state_dict)
         self.exploration_rate = exploration_rate
+        if self.policy is not None:
+            self.policy.invalidate()
+
+        # Checkpoints written before full training state was saved stop here
+        if "optimizer" in ckp:
+            self.optimizer.load_state_dict(ckp["optimizer"])
+        if "curr_step" in ckp:
+            self.curr_step = ckp["curr_step"]
+            self.last_learn_step = ckp["last_learn_step"]
+            print(f"Resuming at step {self.curr_step}")
+        if "rng" in ckp:
+            random.setstate(ckp["rng"]["python"])
+            np.random.set_state(ckp["rng"]["numpy"])
+            torch.set_rng_state(ckp["rng"]["torch"].cpu())
+            if self.use_cuda and ckp["rng"]["cuda"] is not None:
+                torch.cuda.set_rng_state_all([state.cpu() for state in ckp["rng"]["cuda"]])
+        if "replay" in ckp:
+            self.memory.load_state_dict(ckp["replay"])
+            print(f"Restored {len(self.memory)} transitions from the checkpoint")
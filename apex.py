@@ -0,0 +1,218 @@
+import argparse
+import datetime
+import queue
+import time
+from pathlib import Path
+
+import numpy as np
+import torch
+import torch.multiprocessing as mp
+
+from agent import Mario
+from env import build_env
+from memory import REPLAY_BUFFERS, to_uint8
+from metrics import MetricLogger
+from neural import MarioNet
+
+
+def actor_epsilon(index, num_actors, base=0.4, alpha=7.0):
+    """Fixed per-actor exploration rate from Ape-X, eps_i = base^(1 + alpha * i / (N - 1))"""
+    if num_actors == 1:
+        return base
+    return base ** (1 + alpha * index / (num_actors - 1))
+
+
+def load_weights(net, shared_weights, version, lock):
+    with lock:
+        net.load_state_dict(shared_weights)
+        return version.value
+
+
+def actor(index, args, state_dim, shared_weights, version, lock, transitions, stop):
+    """
+    Play with a local copy of the online network and stream transitions to the learner.
+
+    Transitions are sent in chunks of `args.chunk_size` as uint8 stacks, together with
+    the no. of steps they cover and the summed weight staleness (learner versions the
+    acting weights were behind). New weights are picked up at every chunk boundary.
+    """
+    torch.set_num_threads(1)
+    np.random.seed(args.seed + index)
+    torch.manual_seed(args.seed + index)
+
+    env = build_env()
+    net = MarioNet(state_dim, env.action_space.n, device="cpu").online
+    local_version = load_weights(net, shared_weights, version, lock)
+    epsilon = actor_epsilon(index, args.actors)
+
+    chunk, staleness = [], 0
+    episode_reward, episode_length = 0.0, 0
+    state = env.reset()
+    while not stop.is_set():
+        if np.random.rand() < epsilon:
+            action = np.random.randint(env.action_space.n)
+        else:
+            with torch.no_grad():
+                state_t = MarioNet.preprocess(torch.as_tensor(np.asarray(state)).unsqueeze(0))
+                action_values = net(state_t.float())
+            action = torch.argmax(action_values, axis=1).item()
+
+        next_state, reward, done, info = env.step(action)
+        chunk.append((to_uint8(state), to_uint8(next_state), action, reward, done))
+        staleness += version.value - local_version
+        episode_reward += reward
+        episode_length += 1
+        state = next_state
+
+        if done or info["flag_get"]:
+            transitions.put(("episode", index, (episode_reward, episode_length)))
+            episode_reward, episode_length = 0.0, 0
+            state = env.reset()
+
+        if len(chunk) >= args.chunk_size:
+            transitions.put(("transitions", index, (chunk, staleness)))
+            chunk, staleness = [], 0
+            if version.value != local_version:
+                local_version = load_weights(net, shared_weights, version, lock)
+    env.close()
+
+
+def publish_weights(mario, shared_weights, version, lock):
+    with lock:
+        for name, tensor in mario.net.online.state_dict().items():
+            shared_weights[name].copy_(tensor)
+        version.value += 1
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Asynchronous actor/learner (Ape-X style) training on CPU"
+    )
+    parser.add_argument(
+        "--save-dir",
+        type=Path,
+        default=Path("checkpoints") / datetime.datetime.now().strftime("%Y-%m-%dT%H-%M-%S"),
+    )
+    parser.add_argument("--actors", type=int, default=4)
+    parser.add_argument("--episodes", type=int, default=200000)
+    parser.add_argument("--replay", default="frames", choices=list(REPLAY_BUFFERS))
+    parser.add_argument("--replay-capacity", type=int, default=1000000)
+    parser.add_argument("--prioritized", action="store_true")
+    parser.add_argument(
+        "--tau", type=float, default=1.0, help="Polyak target updates after every update if < 1"
+    )
+    parser.add_argument("--burnin", type=int, default=None, help="override Mario.burnin")
+    parser.add_argument(
+        "--publish-every", type=int, default=100, help="learner updates between weight refreshes"
+    )
+    parser.add_argument("--chunk-size", type=int, default=50, help="transitions per actor message")
+    parser.add_argument("--queue-size", type=int, default=256, help="max. chunks in flight")
+    parser.add_argument("--report-every", type=float, default=30.0, help="seconds between reports")
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    save_dir = args.save_dir
+    save_dir.mkdir(parents=True, exist_ok=True)
+
+    env = build_env()
+    state_dim = (4, 21, 21)
+    mario = Mario(
+        state_dim=state_dim,
+        action_dim=env.action_space.n,
+        save_dir=save_dir,
+        replay=args.replay,
+        replay_capacity=args.replay_capacity,
+        prioritized=args.prioritized,
+        tau=args.tau,
+    )
+    env.close()
+    if args.burnin is not None:
+        mario.burnin = args.burnin
+    logger = MetricLogger(save_dir)
+
+    # Weights live in shared memory; actors copy them out under the lock
+    shared_weights = {
+        name: tensor.detach().cpu().clone().share_memory_()
+        for name, tensor in mario.net.online.state_dict().items()
+    }
+    version = mp.Value("l", 0, lock=False)
+    lock = mp.Lock()
+    transitions = mp.Queue(maxsize=args.queue_size)
+    stop = mp.Event()
+    actors = [
+        mp.Process(
+            target=actor,
+            args=(i, args, state_dim, shared_weights, version, lock, transitions, stop),
+            daemon=True,
+        )
+        for i in range(args.actors)
+    ]
+    for process in actors:
+        process.start()
+
+    mean_epsilon = float(np.mean([actor_epsilon(i, args.actors) for i in range(args.actors)]))
+    sync_every_updates = max(1, int(mario.sync_every // mario.learn_every))
+    episodes, updates = 0, 0
+    actor_steps, staleness = 0, 0
+    report_time, report_steps, report_updates = time.time(), 0, 0
+
+    while episodes < args.episodes:
+        # Ingest everything the actors have sent; block only while there is nothing to learn from
+        can_learn = mario.burned_in()
+        while True:
+            try:
+                kind, index, payload = transitions.get(block=not can_learn, timeout=1.0)
+            except queue.Empty:
+                break
+            if kind == "transitions":
+                chunk, chunk_staleness = payload
+                for transition in chunk:
+                    mario.cache(*transition, stream=index)
+                actor_steps += len(chunk)
+                staleness += chunk_staleness
+            else:
+                logger.log_episode(reward=payload[0], length=payload[1])
+                if episodes % 20 == 0:
+                    logger.record(episode=episodes, epsilon=mean_epsilon, step=actor_steps)
+                episodes += 1
+            if not can_learn:
+                break
+
+        last_step, mario.curr_step = mario.curr_step, actor_steps
+        if mario.crossed(mario.save_every, last_step):
+            mario.save()
+
+        if mario.burned_in():
+            q, loss = mario.update()
+            logger.log_step(0.0, loss, q)
+            updates += 1
+            if mario.tau >= 1 and updates % sync_every_updates == 0:  # else update() syncs
+                mario.sync_Q_target()
+            if updates % args.publish_every == 0:
+                publish_weights(mario, shared_weights, version, lock)
+
+        now = time.time()
+        if now - report_time >= args.report_every:
+            elapsed = now - report_time
+            print(
+                f"Actor steps/s {(actor_steps - report_steps) / elapsed:.1f} - "
+                f"Learner updates/s {(updates - report_updates) / elapsed:.1f} - "
+                f"Weight staleness {staleness / max(1, actor_steps - report_steps):.2f} versions - "
+                f"Replay {len(mario.memory)}"
+            )
+            report_time, report_steps, report_updates = now, actor_steps, updates
+            staleness = 0
+
+    stop.set()
+    # Unblock actors waiting on a full queue so they can see the stop event
+    for process in actors:
+        while process.is_alive():
+            try:
+                transitions.get(timeout=0.1)
+            except queue.Empty:
+                pass
+            process.join(timeout=0.1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,984 @@
+import argparse
+import json
+import platform
+import random
+import sys
+import time
+from collections import deque
+from pathlib import Path
+
+import numpy as np
+import torch
+
+from memory import (
+    REPLAY_BUFFERS,
+    FrameReplayBuffer,
+    NStepAccumulator,
+    PrioritizedReplay,
+    ReplayBuffer,
+    SumTree,
+)
+
+
+def synthetic_transitions(state_dim, count, episode_length=200):
+    """
+    Transitions shaped like `build_env()` output: float frames in [0, 1], stacked
+    with the same reset padding and sliding window as `FrameStack`.
+    """
+    history = state_dim[0]
+    transitions = []
+    while len(transitions) < count:
+        frames = [np.random.randint(0, 256, size=state_dim[1:]) / 255.0] * history
+        for t in range(episode_length):
+            state = np.stack(frames[-history:])
+            frames.append(np.random.randint(0, 256, size=state_dim[1:]) / 255.0)
+            next_state = np.stack(frames[-history:])
+            done = t == episode_length - 1
+            transitions.append(
+                (state, next_state, np.random.randint(7), float(np.random.randn()), done)
+            )
+    return transitions[:count]
+
+
+class DequeReplay:
+    """The original `Mario.cache`/`Mario.recall` implementation, kept for comparison"""
+
+    def __init__(self, capacity):
+        self.memory = deque(maxlen=capacity)
+
+    def add(self, state, next_state, action, reward, done):
+        self.memory.append(
+            (
+                torch.FloatTensor(np.array(state)),
+                torch.FloatTensor(np.array(next_state)),
+                torch.LongTensor([action]),
+                torch.DoubleTensor([reward]),
+                torch.BoolTensor([done]),
+            )
+        )
+
+    def sample(self, batch_size):
+        batch = random.sample(self.memory, batch_size)
+        state, next_state, action, reward, done = map(torch.stack, zip(*batch))
+        return state, next_state, action.squeeze(), reward.squeeze(), done.squeeze()
+
+    @property
+    def nbytes(self):
+        return sum(
+            t.element_size() * t.nelement() for item in self.memory for t in item
+        )
+
+
+def time_per_call(fn, repeat):
+    start = time.perf_counter()
+    for _ in range(repeat):
+        fn()
+    return (time.perf_counter() - start) / repeat
+
+
+def bench_replay(args):
+    """Memory footprint and cache/recall latency of the replay backends"""
+    state_dim = (4, 21, 21)
+    transitions = synthetic_transitions(state_dim, 1000)
+    backends = {
+        "deque": DequeReplay(args.capacity),
+        "array": ReplayBuffer(args.capacity, state_dim),
+        "frames": FrameReplayBuffer(args.capacity, state_dim),
+    }
+
+    for name, memory in backends.items():
+        start = time.perf_counter()
+        for i in range(args.size):
+            memory.add(*transitions[i % len(transitions)])
+        add_us = (time.perf_counter() - start) / args.size * 1e6
+        sample_us = time_per_call(lambda: memory.sample(args.batch_size), args.repeat) * 1e6
+        print(
+            f"{name:>8} - "
+            f"size {args.size} - "
+            f"memory {memory.nbytes / 2 ** 20:.1f} MiB - "
+            f"cache {add_us:.2f} us - "
+            f"recall {sample_us:.2f} us"
+        )
+
+
+def bench_per(args):
+    """Sum-tree sample/update cost and prioritized vs. uniform recall at several capacities"""
+    state_dim = (4, 21, 21)
+    for capacity in args.capacities:
+        tree = SumTree(capacity)
+        tree.update(np.arange(capacity), np.random.rand(capacity))
+        values = lambda: np.random.rand(args.batch_size) * tree.total
+        idx = lambda: np.random.randint(0, capacity, size=args.batch_size)
+        find_us = time_per_call(lambda: tree.find(values()), args.repeat) * 1e6
+        update_us = time_per_call(
+            lambda: tree.update(idx(), np.random.rand(args.batch_size)), args.repeat
+        ) * 1e6
+
+        # Uniform vs. prioritized recall on a full frame store of the same capacity
+        frames = FrameReplayBuffer(capacity, state_dim)
+        frames.transitions[:] = True
+        frames.prev[:] = np.maximum(np.arange(capacity) - 1, 0)
+        frames.stamp[:] = np.arange(capacity)
+        frames.size, frames.ptr, frames.written = capacity, 0, capacity
+        per = PrioritizedReplay(frames)
+        uniform_us = time_per_call(lambda: frames.sample(args.batch_size), args.repeat) * 1e6
+        prioritized_us = time_per_call(
+            lambda: per.sample_prioritized(args.batch_size), args.repeat
+        ) * 1e6
+        print(
+            f"capacity {capacity} - "
+            f"tree sample {find_us:.2f} us - "
+            f"tree update {update_us:.2f} us - "
+            f"uniform recall {uniform_us:.2f} us - "
+            f"prioritized recall {prioritized_us:.2f} us"
+        )
+
+
+def bench_vec_env(args):
+    """Environment steps/s of SubprocVecEnv over build_env() for several worker counts"""
+    from env import build_env
+    from vec_env import SubprocVecEnv
+
+    for num_envs in args.num_envs:
+        env = SubprocVecEnv(build_env, num_envs)
+        env.reset()
+        actions = np.random.randint(env.action_space.n, size=(args.steps, num_envs))
+        start = time.perf_counter()
+        for step_actions in actions:
+            env.step(step_actions)
+        elapsed = time.perf_counter() - start
+        env.close()
+        print(f"num_envs {num_envs} - {args.steps * num_envs / elapsed:.1f} steps/s")
+
+
+def bench_act(args):
+    """Per-state cost of choosing actions with act() one by one vs. act_batch()"""
+    from agent import Mario
+
+    state_dim = (4, 21, 21)
+    mario = Mario(state_dim, 7)
+    for exploration_rate in (1.0, 0.0):
+        states = np.random.rand(args.num_envs, *state_dim)
+        mario.exploration_rate = mario.exploration_rate_min = exploration_rate
+        single_us = time_per_call(
+            lambda: [mario.act(state) for state in states], args.repeat
+        ) / args.num_envs * 1e6
+        batch_us = time_per_call(lambda: mario.act_batch(states), args.repeat) / args.num_envs * 1e6
+        print(
+            f"epsilon {exploration_rate} - "
+            f"num_envs {args.num_envs} - "
+            f"act {single_us:.2f} us/state - "
+            f"act_batch {batch_us:.2f} us/state"
+        )
+
+
+def bench_act_compiled(args):
+    """Per-call latency of greedy act() with eager vs. traced vs. torch.compile'd Q_online"""
+    from agent import Mario
+
+    state_dim = (4, 21, 21)
+    states = np.random.randint(0, 256, size=(args.states, *state_dim), dtype=np.uint8)
+    eager = Mario(state_dim, 7)
+    eager.exploration_rate = eager.exploration_rate_min = 0.0
+    expected = [eager.act(state) for state in states]
+    weights = eager.net.state_dict()
+
+    for mode in [None] + args.modes:
+        mario = Mario(state_dim, 7, compile_act=mode, compile_every=args.compile_every)
+        mario.net.load_state_dict(weights)
+        mario.exploration_rate = mario.exploration_rate_min = 0.0
+        start = time.perf_counter()
+        actions = [mario.act(state) for state in states]  # the first call builds
+        first_s = time.perf_counter() - start
+        act_us = time_per_call(lambda: [mario.act(state) for state in states], args.repeat)
+        act_us = act_us / len(states) * 1e6
+        rebuild = ""
+        if mode == "trace":
+            rebuild_s = time_per_call(lambda: mario.policy.build(mario.to_tensor(states[:1])), 5)
+            rebuild = f" - rebuild {rebuild_s * 1e3:.1f} ms"
+        print(
+            f"{mode or 'eager':>8} - "
+            f"act {act_us:.1f} us/call - "
+            f"first pass {first_s:.2f} s{rebuild} - "
+            f"same actions {actions == expected}"
+        )
+
+
+def bench_target_sync(args):
+    """Per-call cost of the Q_target update: load_state_dict vs. fused foreach hard/soft"""
+    from neural import MarioNet, TargetUpdate
+
+    net = MarioNet((4, 21, 21), 7, device="cpu")
+    update = TargetUpdate(net.online, net.target)
+    online = list(net.online.parameters())
+
+    def per_tensor(tau):
+        with torch.no_grad():
+            for target, source in zip(net.target.parameters(), online):
+                target.lerp_(source, tau)
+
+    paths = {
+        "load_state_dict": lambda: net.target.load_state_dict(net.online.state_dict()),
+        "foreach hard": lambda: update(1.0),
+        "foreach soft": lambda: update(args.tau),
+        "per-tensor soft": lambda: per_tensor(args.tau),
+    }
+    for name, fn in paths.items():
+        per_call = time_per_call(fn, args.repeat)
+        print(f"{name:>16} - {per_call * 1e6:8.1f} us/call")
+
+    # Both update kinds must land where the reference formulas do
+    for p in net.online.parameters():
+        p.data.normal_()
+    expected = [t + args.tau * (o - t) for t, o in zip(net.target.parameters(), online)]
+    update(args.tau)
+    soft_ok = all(torch.allclose(t, e) for t, e in zip(net.target.parameters(), expected))
+    update(1.0)
+    hard_ok = all(torch.equal(t, o) for t, o in zip(net.target.parameters(), online))
+    print(f"soft update matches {soft_ok} - hard update matches {hard_ok}")
+
+
+def record_env_transitions(steps, seed=0):
+    """Transitions of a uniformly random policy in build_env(), for learning on real frames"""
+    from env import build_env
+
+    rng = np.random.RandomState(seed)
+    env = build_env()
+    transitions = []
+    state = np.asarray(env.reset())
+    for _ in range(steps):
+        action = rng.randint(env.action_space.n)
+        next_state, reward, done, info = env.step(action)
+        next_state = np.asarray(next_state)
+        done = done or info["flag_get"]
+        transitions.append((state, next_state, action, reward, done))
+        state = np.asarray(env.reset()) if done else next_state
+    env.close()
+    return transitions
+
+
+def bench_mixed_precision(args):
+    """float32 vs. bfloat16 autocast: update/act latency, then learning curves on a fixed seed"""
+    from agent import Mario
+
+    state_dim = (4, 21, 21)
+    transitions = record_env_transitions(args.steps, args.seed)
+    held_out = np.stack([t[0] for t in transitions[-args.held_out :]])
+    transitions = transitions[: -args.held_out]
+
+    curves, q_values = {}, {}
+    for mixed_precision in (None, "all"):
+        name = "bfloat16" if mixed_precision else "float32"
+        torch.manual_seed(args.seed)  # same initial weights
+        mario = Mario(state_dim, 7, replay="frames", mixed_precision=mixed_precision)
+        for transition in transitions:
+            mario.cache(*transition)
+
+        states = np.stack([t[0] for t in transitions[: args.batch]])
+        mario.exploration_rate = mario.exploration_rate_min = 0.0
+        act_us = median_time(lambda: mario.act(states[0]), args.repeat) * 1e6
+        act_batch_us = median_time(lambda: mario.act_batch(states), args.repeat) * 1e6
+        update_ms = median_time(mario.update, max(1, args.repeat // 10)) * 1e3
+        print(
+            f"{name:>9} - act {act_us:.0f} us - act_batch({args.batch}) {act_batch_us:.0f} us - "
+            f"update {update_ms:.1f} ms"
+        )
+
+        # Learning curve from the same start, on the same sampled batches
+        torch.manual_seed(args.seed)
+        mario = Mario(state_dim, 7, replay="frames", mixed_precision=mixed_precision)
+        for transition in transitions:
+            mario.cache(*transition)
+        np.random.seed(args.seed)
+        losses = []
+        for update in range(1, args.updates + 1):
+            losses.append(mario.update()[1])
+            if update % args.sync_every == 0:
+                mario.sync_Q_target()
+        curves[name] = np.array(losses)
+        with torch.no_grad():  # both evaluated in float32, to compare the weights learned
+            q_values[name] = mario.net(mario.to_tensor(held_out), model="online")
+
+    chunks = np.array_split(np.arange(args.updates), 10)
+    for name, losses in curves.items():
+        print(f"{name:>9} - loss by tenth: " + " ".join(f"{losses[c].mean():.4f}" for c in chunks))
+    diff = (q_values["float32"] - q_values["bfloat16"]).abs().max().item()
+    agree = (q_values["float32"].argmax(1) == q_values["bfloat16"].argmax(1)).float().mean()
+    print(
+        f"after {args.updates} updates - held-out max Q diff {diff:.4f} "
+        f"(Q scale {q_values['float32'].abs().mean():.4f}) - greedy actions agree {agree:.1%}"
+    )
+
+
+def bench_prefetch(args):
+    """Training-loop throughput with update() sampling inline vs. from the prefetch thread"""
+    from agent import Mario
+    from metrics import PhaseTimer
+
+    state_dim = (4, 21, 21)
+    transitions = synthetic_transitions(state_dim, 5000)
+    for depth in [0] + args.depths:
+        torch.manual_seed(args.seed)
+        np.random.seed(args.seed)
+        mario = Mario(
+            state_dim,
+            7,
+            replay=args.replay,
+            replay_capacity=args.replay_size,
+            prioritized=args.prioritized,
+            timer=PhaseTimer(),
+            prefetch=depth,
+        )
+        for i in range(args.replay_size // 2):
+            mario.cache(*transitions[i % len(transitions)])
+        mario.update()  # the first batch starts the prefetcher
+        mario.timer.pop()
+        if mario.prefetcher is not None:
+            mario.prefetcher.stats()
+
+        # cache() keeps writing while the prefetcher samples, as in training
+        start = time.perf_counter()
+        for i in range(args.updates):
+            for j in range(mario.learn_every):
+                mario.cache(*transitions[(i * mario.learn_every + j) % len(transitions)])
+            mario.update()
+        elapsed = time.perf_counter() - start
+        seconds, _ = mario.timer.pop()
+        prefetch = ""
+        if mario.prefetcher is not None:
+            stats = mario.prefetcher.stats()
+            prefetch = (
+                f" - mean queue depth {stats['queue_depth']:.2f} - stalls {stats['stalls']}"
+                f" - stale priority updates {stats['stale_priorities']}"
+            )
+            mario.prefetcher.close()
+        print(
+            f"prefetch {depth} - {args.updates / elapsed:.1f} updates/s - "
+            f"sample {seconds['sample'] / args.updates * 1e3:.2f} ms/update{prefetch}"
+        )
+
+
+def find_wrapper(env, wrapper_type):
+    while not isinstance(env, wrapper_type):
+        env = env.env
+    return env
+
+
+def bench_preprocess(args):
+    """Per-step latency of build_env() with the wrapper chain vs. FusedObservation"""
+    from gym.wrappers import GrayScaleObservation, TransformObservation
+
+    from env import build_env
+    from wrappers import CutAndScaleObservation, FusedObservation
+
+    # Observation processing alone, on raw frames recorded from the emulator
+    chain, fused = build_env(fused=False), build_env(fused=True)
+    chain.reset()
+    raw = [chain.unwrapped.screen.copy()]
+    for action in np.random.RandomState(args.seed).randint(7, size=99):
+        _, _, done, _ = chain.step(action)
+        raw.append(chain.unwrapped.screen.copy())
+        if done:
+            chain.reset()
+    gray = find_wrapper(chain, GrayScaleObservation)
+    cut = find_wrapper(chain, CutAndScaleObservation)
+    transform = find_wrapper(chain, TransformObservation)
+    fuse = find_wrapper(fused, FusedObservation)
+
+    def chain_observation(frame):
+        return transform.observation(cut.observation(gray.observation(frame)))
+
+    def fused_observation(frame):
+        fuse.frames[:-1] = fuse.frames[1:]
+        fuse.frames[-1] = fuse.process(frame)
+        return fuse.stacked()
+
+    for name, fn in (("chain", chain_observation), ("fused", fused_observation)):
+        per_frame = time_per_call(lambda: [fn(frame) for frame in raw], 10) / len(raw)
+        print(f"{name:>6} - observation {per_frame * 1e6:.1f} us/step")
+    chain.close()
+    fused.close()
+
+    # Full build_env() step, emulator included
+    actions = np.random.RandomState(args.seed).randint(7, size=args.steps)
+    for fused in (False, True):
+        env = build_env(fused=fused)
+        env.reset()
+        start = time.perf_counter()
+        for action in actions:
+            _, _, done, info = env.step(action)
+            if done or info["flag_get"]:
+                env.reset()
+        elapsed = time.perf_counter() - start
+        env.close()
+        print(f"{'fused' if fused else 'chain':>6} - env step {elapsed / args.steps * 1e6:.1f} us/step")
+
+
+def bench_resize(args):
+    """
+    Latency of the resize backends on recorded frames, single and batched, and their
+    agreement with the original skimage call of each wrapper, which the "skimage"
+    backend must reproduce bit for bit.
+    """
+    from skimage import transform
+
+    from env import build_env
+    from wrappers import RESIZE_BACKENDS, resize
+
+    # Gray 240x256 frames from the emulator, plus the 120x128 crop build_env() uses
+    env = build_env()
+    env.reset()
+    gray = []
+    for action in np.random.RandomState(args.seed).randint(7, size=args.batch_size):
+        _, _, done, _ = env.step(action)
+        screen = env.unwrapped.screen
+        gray.append(np.dot(screen, [0.299, 0.587, 0.114]).astype(np.uint8))
+        if done:
+            env.reset()
+    env.close()
+    gray = np.stack(gray)
+
+    # The calls CutAndScaleObservation and ResizeObservation made before the backends existed
+    def cut_and_scale(frame):
+        return (transform.resize(frame, (21, 21)) * 255).astype(np.uint8)
+
+    def resize_observation(frame):
+        return transform.resize(
+            frame, (84, 84), preserve_range=True, anti_aliasing=True
+        ).astype(np.uint8)
+
+    cases = (
+        (gray[:, 120:, 128:], (21, 21), False, cut_and_scale),
+        (gray, (84, 84), True, resize_observation),
+    )
+    for frames, shape, preserve_range, original in cases:
+        reference = np.stack([original(frame) for frame in frames])
+        skimage = resize(frames, shape, "skimage", preserve_range)
+        if not np.array_equal(skimage, reference):
+            mismatched = np.mean(skimage != reference)
+            raise AssertionError(f"skimage backend differs from the original on {mismatched:.1%}")
+        for backend in RESIZE_BACKENDS:
+            def call(x):
+                return resize(x, shape, backend, preserve_range)
+
+            single_us = time_per_call(lambda: call(frames[0]), args.repeat) * 1e6
+            batch_us = time_per_call(lambda: call(frames), args.repeat) * 1e6
+            diff = np.abs(call(frames).astype(np.int16) - reference)
+            print(
+                f"{backend:>8} - "
+                f"{frames.shape[1]}x{frames.shape[2]} -> {shape[0]}x{shape[1]} - "
+                f"single {single_us:.1f} us - "
+                f"batch of {len(frames)} {batch_us:.1f} us - "
+                f"vs original mean {diff.mean():.2f} max {diff.max()} "
+                f"identical {np.mean(diff == 0):.1%}"
+            )
+
+
+def check_fused(args):
+    """Compare FusedObservation stacks with the wrapper chain over the same action sequence"""
+    from env import build_env
+
+    actions = np.random.RandomState(args.seed).randint(7, size=args.steps)
+    envs = [build_env(fused=False), build_env(fused=True, backend=args.backend)]
+    observations = [env.reset() for env in envs]
+    diffs = []
+    for action in actions:
+        diffs.append(np.abs(np.asarray(observations[0]) - np.asarray(observations[1])) * 255)
+        results = [env.step(action) for env in envs]
+        observations = [result[0] for result in results]
+        _, _, done, info = results[0]
+        if done or info["flag_get"]:
+            observations = [env.reset() for env in envs]
+    diffs = np.rint(np.stack(diffs))  # float32 vs. float64 scaling leaves ~1e-5 noise
+    print(
+        f"fused - {len(diffs)} steps - "
+        f"max abs diff {diffs.max():.2f} - "
+        f"mean abs diff {diffs.mean():.3f} gray levels"
+    )
+    assert diffs.max() <= args.max_diff, f"max diff {diffs.max():.2f} > {args.max_diff}"
+    assert diffs.mean() <= args.mean_diff, f"mean diff {diffs.mean():.3f} > {args.mean_diff}"
+
+
+def check_uint8(args):
+    """Compare Q-values of the [0, 1] float pipeline and the uint8 one on the same frames"""
+    from agent import Mario
+    from env import build_env
+
+    mario = Mario((4, 21, 21), 7)
+    actions = np.random.RandomState(args.seed).randint(7, size=args.steps)
+    envs = [build_env(uint8=False), build_env(uint8=True)]
+    states = [[], []]
+    observations = [env.reset() for env in envs]
+    for action in actions:
+        for recorded, observation in zip(states, observations):
+            recorded.append(np.asarray(observation))
+        results = [env.step(action) for env in envs]
+        observations = [result[0] for result in results]
+        _, _, done, info = results[0]
+        if done or info["flag_get"]:
+            observations = [env.reset() for env in envs]
+
+    float_states, uint8_states = (np.stack(recorded) for recorded in states)
+    with torch.no_grad():
+        float_q = mario.net(mario.to_tensor(float_states), model="online")
+        uint8_q = mario.net(mario.to_tensor(uint8_states), model="online")
+    diff = (float_q - uint8_q).abs().max().item()
+    print(
+        f"uint8 - {len(actions)} states - "
+        f"observation {float_states[0].nbytes} vs {uint8_states[0].nbytes} bytes - "
+        f"max Q diff {diff:.2e} - "
+        f"greedy actions equal {torch.equal(float_q.argmax(1), uint8_q.argmax(1))}"
+    )
+    assert diff <= args.atol, f"max Q diff {diff:.2e} > {args.atol}"
+
+
+def check_update(args):
+    """Check the fused learner step against the three-forward one: losses, gradients, time"""
+    from agent import Mario
+
+    torch.manual_seed(args.seed)
+    np.random.seed(args.seed)
+    state_dim = (4, 21, 21)
+    mario = Mario(state_dim, 7, replay="frames", replay_capacity=4096, n_steps=args.n_steps)
+    mario.sync_Q_target()
+    for p in mario.net.target.parameters():
+        p.data.mul_(0.9)  # a target that lags the online network, as during training
+    for transition in synthetic_transitions(state_dim, 2000):
+        mario.cache(*transition)
+    state, next_state, action, reward, done, steps = mario.recall()
+    weights = torch.rand(len(action))  # importance-sampling weights, as prioritized replay uses
+
+    def loss_and_grads(fused):
+        mario.optimizer.zero_grad()
+        if fused:
+            td_est, td_tgt = mario.td_fused(state, next_state, action, reward, done, steps)
+        else:
+            td_est = mario.td_estimate(state, action)
+            td_tgt = mario.td_target(reward, next_state, done, steps)
+        loss = (mario.loss_fn(td_est, td_tgt) * weights).mean()
+        loss.backward()
+        return loss.item(), [p.grad.clone() for p in mario.net.online.parameters()]
+
+    loss, grads = loss_and_grads(fused=False)
+    fused_loss, fused_grads = loss_and_grads(fused=True)
+    grad_diff = max((a - b).abs().max().item() for a, b in zip(grads, fused_grads))
+    bitwise = loss == fused_loss and all(torch.equal(a, b) for a, b in zip(grads, fused_grads))
+
+    timings = {}
+    for fused in (False, True):
+        mario.fused_update = fused
+        timings[fused] = median_time(mario.update, args.repeat)
+    print(
+        f"n_steps {args.n_steps} - "
+        f"loss {loss:.6g} vs {fused_loss:.6g} - max grad diff {grad_diff:.2e} - "
+        f"bit-for-bit {bitwise} - "
+        f"update {timings[False] * 1e3:.1f} ms vs fused {timings[True] * 1e3:.1f} ms"
+    )
+    assert abs(loss - fused_loss) <= args.atol, f"loss diff {abs(loss - fused_loss):.2e}"
+    assert grad_diff <= args.atol, f"max grad diff {grad_diff:.2e} > {args.atol}"
+
+
+def check_frames(args):
+    """Check that FrameReplayBuffer reconstructs exactly the stacks ReplayBuffer stores"""
+    state_dim = (4, 21, 21)
+    # Round-robin over several streams, as a vectorized env feeds the buffer
+    streams = [
+        synthetic_transitions(state_dim, args.size // args.streams, args.episode_length)
+        for _ in range(args.streams)
+    ]
+    n_step = NStepAccumulator(args.n_steps, gamma=0.9)
+    transitions = [
+        (i, n_transition)
+        for step in zip(*streams)
+        for i, t in enumerate(step)
+        for n_transition in n_step.push(*t, stream=i)
+    ]
+    stacks = ReplayBuffer(len(transitions), state_dim)
+    frames = FrameReplayBuffer(args.capacity, state_dim)
+    slots = np.array([frames.add(*t, stream=i) for i, t in transitions])
+    for _, t in transitions:
+        stacks.add(*t)
+
+    # Only the most recent transitions survive in a frame buffer smaller than the stream
+    owner = {slot: i for i, slot in enumerate(slots)}
+    idx = np.array(sorted(owner.values()))
+    idx = idx[frames.valid(slots[idx])]
+    expected = stacks.gather(idx)
+    actual = frames.gather(slots[idx])
+    names = ("state", "next_state", "action", "reward", "done", "steps")
+    for name, e, a in zip(names, expected, actual):
+        assert torch.equal(e, a), f"{name} mismatch"
+    print(f"frames - {args.n_steps}-step - {len(idx)} transitions reconstructed exactly")
+
+
+def bench_curriculum(args):
+    """Emulator frames per unit of x_pos progress with and without SnapshotCurriculum"""
+    from curriculum import find_curriculum
+    from env import build_env
+
+    for fraction in args.fractions:
+        env = build_env(fused=True, curriculum=fraction)
+        curriculum = find_curriculum(env)
+        curriculum.rng = np.random.default_rng(args.seed)
+        rng = np.random.default_rng(args.seed)
+        while curriculum.frames < args.frames:
+            env.reset()
+            done = False
+            while not done:
+                # A right-biased random policy (SIMPLE_MOVEMENT 1-4 all move right)
+                action = rng.integers(1, 5) if rng.random() < 0.9 else rng.integers(7)
+                _, _, done, _ = env.step(action)
+        env.close()
+        stats = curriculum.stats()
+        print(
+            f"fraction {fraction} - "
+            f"{stats['episodes']} episodes ({stats['snapshot_episodes']} from snapshots) - "
+            f"{stats['frames']} frames ({stats['replay_frames']} replaying) - "
+            f"x_pos progress {stats['x_progress']} - "
+            f"{stats['frames_per_x']:.2f} frames/x_pos - "
+            f"furthest x_pos {stats['furthest_x']}"
+        )
+
+
+def median_time(fn, repeat, rounds=5):
+    """Median over `rounds` of the mean time per call, less sensitive to a noisy machine"""
+    return float(np.median([time_per_call(fn, repeat) for _ in range(rounds)]))
+
+
+def overhead_time(fn, base_fn, base_calls, repeat, rounds=5):
+    """
+    Median over `rounds` of the time per call of `fn` less `base_calls` calls of
+    `base_fn`, the two timed back to back in each round so that both see the same
+    machine load. Clipped at zero: a difference below the noise is no overhead.
+    """
+    overheads = []
+    for _ in range(rounds):
+        overheads.append(time_per_call(fn, repeat) - base_calls * time_per_call(base_fn, repeat))
+    return max(0.0, float(np.median(overheads)))
+
+
+class RecordedEnv:
+    """
+    Play back steps recorded from the emulator, so a wrapper on top of it is timed
+    without the emulator underneath.
+    """
+
+    def __init__(self, first_obs, steps, observation_space, action_space):
+        self.first_obs = first_obs
+        self.steps = steps
+        self.observation_space = observation_space
+        self.action_space = action_space
+        self.metadata, self.reward_range, self.spec = {}, (-np.inf, np.inf), None
+        self.i = 0
+
+    @property
+    def unwrapped(self):
+        return self
+
+    def reset(self, **kwargs):
+        self.i = 0
+        return self.first_obs
+
+    def step(self, action):
+        obs, reward, done, info = self.steps[self.i % len(self.steps)]
+        self.i += 1
+        return obs, reward, False, dict(info)  # never done, the wrappers keep stepping
+
+    def close(self):
+        pass
+
+
+def suite_env(args, results):
+    import gym_super_mario_bros
+    from gym.spaces import Box
+    from gym_super_mario_bros.actions import SIMPLE_MOVEMENT
+    from nes_py.wrappers import JoypadSpace
+
+    from env import build_env
+    from wrappers import (
+        CustomRewardMario,
+        CutAndScaleObservation,
+        FusedObservation,
+        ResizeObservation,
+        SkipFrame,
+    )
+
+    actions = np.random.RandomState(args.seed).randint(7, size=args.steps)
+
+    def steps_of(env):
+        env.reset()
+        start = time.perf_counter()
+        for action in actions:
+            _, _, done, info = env.step(action)
+            if done or info["flag_get"]:
+                env.reset()
+        return (time.perf_counter() - start) / args.steps
+
+    # Raw emulator, recording RGB and gray frames for the wrapper measurements
+    raw = JoypadSpace(gym_super_mario_bros.make("SuperMarioBros-1-2-v0"), SIMPLE_MOVEMENT)
+    first = raw.reset()
+    recorded = []
+    for action in actions[: args.record]:
+        obs, reward, done, info = raw.step(action)
+        recorded.append((obs, reward, done, info))
+        if done:
+            raw.reset()
+    results["emulator_step"] = steps_of(raw)
+    raw.close()
+
+    gray = lambda frame: np.dot(frame, [0.299, 0.587, 0.114]).astype(np.uint8)
+    gray_steps = [(gray(obs), *rest) for obs, *rest in recorded]
+    rgb_space, gray_space = raw.observation_space, Box(0, 255, (240, 256), np.uint8)
+    # name: (wrap, on gray frames, inner steps per step)
+    wrappers = {
+        "custom_reward": (lambda env: CustomRewardMario(env), False, 1),
+        "skip_frame": (lambda env: SkipFrame(env, skip=4), False, 4),
+        "cut_and_scale": (lambda env: CutAndScaleObservation(env), True, 1),
+        "resize_84": (lambda env: ResizeObservation(env, 84), True, 1),
+        "fused": (lambda env: FusedObservation(env), False, 1),
+    }
+    for name, (wrap, on_gray, inner_steps) in wrappers.items():
+        inner = (
+            RecordedEnv(gray(first), gray_steps, gray_space, raw.action_space)
+            if on_gray
+            else RecordedEnv(first, recorded, rgb_space, raw.action_space)
+        )
+        env = wrap(inner)
+        env.reset()
+        results[f"wrapper_{name}"] = overhead_time(
+            lambda: env.step(0), lambda: inner.step(0), inner_steps, args.repeat
+        )
+
+    for fused in (False, True):
+        env = build_env(fused=fused)
+        results[f"build_env_{'fused' if fused else 'chain'}_step"] = steps_of(env)
+        env.close()
+
+
+def suite_agent(args, results):
+    from agent import Mario
+
+    state_dim = (4, 21, 21)
+    mario = Mario(state_dim, 7, replay=args.replay, replay_capacity=args.replay_size)
+    transitions = synthetic_transitions(state_dim, 2000)
+    step = iter(range(10 ** 9))
+
+    for name, exploration_rate in (("explore", 1.0), ("exploit", 0.0)):
+        mario.exploration_rate = mario.exploration_rate_min = exploration_rate
+        results[f"act_{name}"] = median_time(
+            lambda: mario.act(transitions[next(step) % len(transitions)][0]), args.repeat
+        )
+
+    # Fill the replay to a realistic size, then time cache() on the full buffer
+    for i in range(args.replay_size):
+        mario.cache(*transitions[i % len(transitions)])
+    results["cache"] = median_time(
+        lambda: mario.cache(*transitions[next(step) % len(transitions)]), args.repeat
+    )
+    results["recall"] = median_time(mario.recall, args.repeat)
+    results["learn_update"] = median_time(mario.update, max(1, args.repeat // 10))
+
+
+def compare(results, baseline, threshold, noise_floor=0.0):
+    """
+    Print the change against `baseline`; return the names that got slower than
+    `threshold`, relative, and by more than `noise_floor` seconds, absolute.
+    """
+    regressions = []
+    for name, seconds in results.items():
+        if name not in baseline:
+            print(f"{name:>28} - {seconds * 1e6:10.1f} us - no baseline")
+            continue
+        change = seconds / baseline[name] - 1 if baseline[name] > 0 else float("inf")
+        slower = change > threshold and seconds - baseline[name] > noise_floor
+        print(
+            f"{name:>28} - {seconds * 1e6:10.1f} us - "
+            f"baseline {baseline[name] * 1e6:10.1f} us - {change:+7.1%}"
+            f"{' REGRESSION' if slower else ''}"
+        )
+        if slower:
+            regressions.append(name)
+    return regressions
+
+
+def run_suite(args):
+    """Time the hot paths (emulator, each wrapper, build_env, act/cache/recall/learn) into JSON"""
+    results = {}
+    if "env" in args.parts:
+        suite_env(args, results)
+    if "agent" in args.parts:
+        suite_agent(args, results)
+
+    report = {
+        "meta": {
+            "time": time.strftime("%Y-%m-%dT%H:%M:%S"),
+            "python": platform.python_version(),
+            "machine": platform.machine(),
+            "numpy": np.__version__,
+            "torch": torch.__version__,
+            "torch_threads": torch.get_num_threads(),
+            "replay": args.replay,
+            "replay_size": args.replay_size,
+        },
+        "seconds_per_call": results,
+    }
+    args.output.write_text(json.dumps(report, indent=2))
+    print(f"Results written to {args.output}")
+
+    baseline = {}
+    if args.baseline.exists():
+        baseline = json.loads(args.baseline.read_text())["seconds_per_call"]
+    regressions = compare(results, baseline, args.threshold, args.noise_floor * 1e-6)
+    if args.update_baseline:
+        args.baseline.write_text(json.dumps(report, indent=2))
+        print(f"Baseline updated at {args.baseline}")
+    elif regressions:
+        print(
+            f"{len(regressions)} regression(s) over {args.threshold:.0%} "
+            f"and {args.noise_floor:.1f} us: "
+            f"{', '.join(regressions)}"
+        )
+        sys.exit(1)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Micro-benchmarks for the Mario training pipeline")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    replay = subparsers.add_parser("replay", help=bench_replay.__doc__)
+    replay.add_argument("--capacity", type=int, default=100000)
+    replay.add_argument("--size", type=int, default=100000)
+    replay.add_argument("--batch-size", type=int, default=32)
+    replay.add_argument("--repeat", type=int, default=1000)
+    replay.set_defaults(func=bench_replay)
+
+    per = subparsers.add_parser("per", help=bench_per.__doc__)
+    per.add_argument("--capacities", type=int, nargs="+", default=[100000, 1000000])
+    per.add_argument("--batch-size", type=int, default=32)
+    per.add_argument("--repeat", type=int, default=1000)
+    per.set_defaults(func=bench_per)
+
+    vec_env = subparsers.add_parser("vec-env", help=bench_vec_env.__doc__)
+    vec_env.add_argument("--num-envs", type=int, nargs="+", default=[1, 2, 4, 8])
+    vec_env.add_argument("--steps", type=int, default=1000)
+    vec_env.set_defaults(func=bench_vec_env)
+
+    act = subparsers.add_parser("act", help=bench_act.__doc__)
+    act.add_argument("--num-envs", type=int, default=16)
+    act.add_argument("--repeat", type=int, default=200)
+    act.set_defaults(func=bench_act)
+
+    act_compiled = subparsers.add_parser("act-compiled", help=bench_act_compiled.__doc__)
+    act_compiled.add_argument(
+        "--modes", nargs="+", default=["trace", "compile"], choices=["trace", "compile"]
+    )
+    act_compiled.add_argument("--states", type=int, default=100)
+    act_compiled.add_argument("--repeat", type=int, default=20)
+    act_compiled.add_argument("--compile-every", type=int, default=100)
+    act_compiled.set_defaults(func=bench_act_compiled)
+
+    target_sync = subparsers.add_parser("target-sync", help=bench_target_sync.__doc__)
+    target_sync.add_argument("--tau", type=float, default=0.005)
+    target_sync.add_argument("--repeat", type=int, default=1000)
+    target_sync.set_defaults(func=bench_target_sync)
+
+    mixed = subparsers.add_parser("mixed-precision", help=bench_mixed_precision.__doc__)
+    mixed.add_argument("--steps", type=int, default=3000, help="env steps to learn from")
+    mixed.add_argument("--held-out", type=int, default=200)
+    mixed.add_argument("--updates", type=int, default=1000)
+    mixed.add_argument("--sync-every", type=int, default=100, help="updates between syncs")
+    mixed.add_argument("--batch", type=int, default=16)
+    mixed.add_argument("--repeat", type=int, default=100)
+    mixed.add_argument("--seed", type=int, default=0)
+    mixed.set_defaults(func=bench_mixed_precision)
+
+    prefetch = subparsers.add_parser("prefetch", help=bench_prefetch.__doc__)
+    prefetch.add_argument("--depths", type=int, nargs="+", default=[2])
+    prefetch.add_argument("--replay", default="frames", choices=list(REPLAY_BUFFERS))
+    prefetch.add_argument("--replay-size", type=int, default=20000)
+    prefetch.add_argument("--prioritized", action="store_true")
+    prefetch.add_argument("--updates", type=int, default=200)
+    prefetch.add_argument("--seed", type=int, default=0)
+    prefetch.set_defaults(func=bench_prefetch)
+
+    preprocess = subparsers.add_parser("preprocess", help=bench_preprocess.__doc__)
+    preprocess.add_argument("--steps", type=int, default=1000)
+    preprocess.add_argument("--seed", type=int, default=0)
+    preprocess.set_defaults(func=bench_preprocess)
+
+    fused = subparsers.add_parser("check-fused", help=check_fused.__doc__)
+    fused.add_argument("--steps", type=int, default=1000)
+    fused.add_argument("--seed", type=int, default=0)
+    fused.add_argument("--backend", default="cv2", help="resize backend of FusedObservation")
+    fused.add_argument("--max-diff", type=float, default=48.0, help="gray levels")
+    fused.add_argument("--mean-diff", type=float, default=4.0, help="gray levels")
+    fused.set_defaults(func=check_fused)
+
+    resize = subparsers.add_parser("resize", help=bench_resize.__doc__)
+    resize.add_argument("--batch-size", type=int, default=16)
+    resize.add_argument("--repeat", type=int, default=100)
+    resize.add_argument("--seed", type=int, default=0)
+    resize.set_defaults(func=bench_resize)
+
+    uint8 = subparsers.add_parser("check-uint8", help=check_uint8.__doc__)
+    uint8.add_argument("--steps", type=int, default=500)
+    uint8.add_argument("--seed", type=int, default=0)
+    uint8.add_argument("--atol", type=float, default=1e-5)
+    uint8.set_defaults(func=check_uint8)
+
+    update = subparsers.add_parser("check-update", help=check_update.__doc__)
+    update.add_argument("--n-steps", type=int, default=1)
+    update.add_argument("--repeat", type=int, default=30)
+    update.add_argument("--atol", type=float, default=1e-6)
+    update.add_argument("--seed", type=int, default=0)
+    update.set_defaults(func=check_update)
+
+    frames = subparsers.add_parser("check-frames", help=check_frames.__doc__)
+    frames.add_argument("--size", type=int, default=5000)
+    frames.add_argument("--capacity", type=int, default=3000)
+    frames.add_argument("--episode-length", type=int, default=50)
+    frames.add_argument("--streams", type=int, default=3)
+    frames.add_argument("--n-steps", type=int, default=1)
+    frames.set_defaults(func=check_frames)
+
+    curriculum = subparsers.add_parser("curriculum", help=bench_curriculum.__doc__)
+    curriculum.add_argument("--fractions", type=float, nargs="+", default=[0.0, 0.5])
+    curriculum.add_argument("--frames", type=int, default=40000, help="emulator frames per run")
+    curriculum.add_argument("--seed", type=int, default=0)
+    curriculum.set_defaults(func=bench_curriculum)
+
+    suite = subparsers.add_parser("suite", help=run_suite.__doc__)
+    suite.add_argument("--parts", nargs="+", default=["env", "agent"], choices=["env", "agent"])
+    suite.add_argument("--steps", type=int, default=1000, help="env steps per env measurement")
+    suite.add_argument(
+        "--record", type=int, default=200, help="emulator steps replayed to the wrappers"
+    )
+    suite.add_argument("--repeat", type=int, default=200, help="calls per timing round")
+    suite.add_argument("--replay", default="frames", choices=list(REPLAY_BUFFERS))
+    suite.add_argument("--replay-size", type=int, default=100000)
+    suite.add_argument("--seed", type=int, default=0)
+    suite.add_argument("--output", type=Path, default=Path("benchmark_results.json"))
+    suite.add_argument("--baseline", type=Path, default=Path("benchmark_baseline.json"))
+    suite.add_argument(
+        "--threshold", type=float, default=0.2, help="fail when a path is this much slower"
+    )
+    suite.add_argument(
+        "--noise-floor",
+        type=float,
+        default=2.0,
+        help="us; a path must also be this much slower to fail",
+    )
+    suite.add_argument(
+        "--update-baseline", action="store_true", help="store these results as the baseline"
+    )
+    suite.set_defaults(func=run_suite)
+
+    args = parser.parse_args()
+    np.random.seed(0)
+    random.seed(0)
+    torch.manual_seed(0)
+    args.func(args)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,96 @@
+import atexit
+import os
+import queue
+import re
+import threading
+from pathlib import Path
+
+import numpy as np
+import torch
+
+CHECKPOINT_PATTERN = re.compile(r"mario_net_(\d+)\.chkpt$")
+
+
+def snapshot(obj):
+    """
+    Copy everything a checkpoint refers to, so training can keep mutating the live
+    tensors and arrays while the copy is written in the background.
+    """
+    if isinstance(obj, torch.Tensor):
+        return obj.detach().to("cpu", copy=True)
+    if isinstance(obj, np.ndarray):
+        return obj.copy()
+    if isinstance(obj, dict):
+        return {key: snapshot(value) for key, value in obj.items()}
+    if isinstance(obj, (list, tuple)):
+        return type(obj)(snapshot(value) for value in obj)
+    return obj
+
+
+def list_checkpoints(save_dir):
+    """Complete checkpoints in `save_dir`, oldest first"""
+    found = []
+    for path in Path(save_dir).glob("mario_net_*.chkpt"):
+        match = CHECKPOINT_PATTERN.search(path.name)
+        if match:
+            found.append((int(match.group(1)), path))
+    return [path for _, path in sorted(found)]
+
+
+def latest_checkpoint(save_dir):
+    checkpoints = list_checkpoints(save_dir)
+    return checkpoints[-1] if checkpoints else None
+
+
+class Checkpointer:
+    """
+    Write checkpoints from a background thread.
+
+    `save()` only takes a snapshot and queues it; the thread writes it to a
+    temporary file and renames it into place, so a checkpoint either exists
+    completely or not at all. Once written, all but the newest `keep_last`
+    checkpoints are deleted (`keep_last=None` keeps everything).
+    """
+
+    def __init__(self, save_dir, keep_last=5):
+        self.save_dir = Path(save_dir)
+        self.keep_last = keep_last
+        self.queue = queue.Queue(maxsize=2)  # save() blocks only if the writer is two behind
+        self.thread = threading.Thread(target=self._run, name="checkpointer", daemon=True)
+        self.thread.start()
+        atexit.register(self.close)
+
+    def save(self, state, save_path):
+        self.queue.put((snapshot(state), Path(save_path)))
+
+    def _run(self):
+        while True:
+            item = self.queue.get()
+            try:
+                if item is None:
+                    return
+                state, save_path = item
+                tmp_path = save_path.with_name(save_path.name + ".tmp")
+                torch.save(state, tmp_path)
+                os.replace(tmp_path, save_path)
+                print(f"MarioNet saved to {save_path} at step {state.get('curr_step')}")
+                self._apply_retention()
+            except Exception as e:  # keep the writer alive for the next checkpoint
+                print(f"Failed to save {save_path}: {e!r}")
+            finally:
+                self.queue.task_done()
+
+    def _apply_retention(self):
+        if self.keep_last is None:
+            return
+        for path in list_checkpoints(self.save_dir)[: -self.keep_last]:
+            path.unlink()
+
+    def wait(self):
+        """Block until every queued checkpoint is on disk"""
+        self.queue.join()
+
+    def close(self):
+        if self.thread.is_alive():
+            self.queue.put(None)
+            self.thread.join()
@@ -0,0 +1,156 @@
+from collections import defaultdict
+
+import gym
+import numpy as np
+
+
+class SnapshotCurriculum(gym.Wrapper):
+    """
+    Start a fraction of the episodes from mid-level snapshots instead of the level start.
+
+    Wraps the `JoypadSpace` env directly, so every step is one emulator frame. Each time
+    an episode reaches a new x_pos bucket a snapshot of that point is archived, keyed by
+    (world, stage, bucket). nes_py has a single backup slot, so a snapshot is the list
+    of actions that leads there from the level start: loading one power-cycles the
+    emulator back to the start, replays the actions and backs the result up, after which
+    every `reset()` restores it. A start is kept for `reuse` episodes to spread the cost
+    of the replay. Snapshots are picked in proportion to the deaths in the buckets just
+    ahead of them, and the archive keeps at most `capacity` of them.
+    """
+
+    def __init__(
+        self, env, fraction=0.5, bucket_size=128, capacity=64, reuse=8, lookahead=2, seed=None
+    ):
+        super().__init__(env)
+        self.fraction = fraction
+        self.bucket_size = bucket_size
+        self.capacity = capacity
+        self.reuse = reuse
+        self.lookahead = lookahead
+        self.rng = np.random.default_rng(seed)
+
+        self.archive = {}  # (world, stage, bucket) -> {"actions", "x_pos"}
+        self.deaths = defaultdict(int)  # (world, stage, bucket) -> deaths
+        self.slot = None  # key of the snapshot in the backup slot, None for the level start
+        self.slot_actions = []  # the actions that lead to it, kept even if it leaves the archive
+        self.slot_episodes = 0
+
+        self.level = None
+        self.actions = []
+        self.start_x = None
+        self.max_x = 0
+
+        # Every emulator frame, including the ones spent replaying to a snapshot
+        self.frames = 0
+        self.replay_frames = 0
+        self.progress = 0  # x_pos gained per episode, summed
+        self.furthest = 0
+        self.episodes = 0
+        self.snapshot_episodes = 0
+
+    def _bucket(self, x_pos):
+        return x_pos // self.bucket_size
+
+    def _weight(self, key):
+        world, stage, bucket = key
+        ahead = range(bucket, bucket + self.lookahead + 1)
+        return 1 + sum(self.deaths[(world, stage, b)] for b in ahead)
+
+    def _power_cycle(self):
+        """Return the emulator to the level start exactly as SuperMarioBrosEnv builds it"""
+        nes = self.unwrapped
+        nes.ram[:] = 0  # a reset keeps RAM, which makes replayed actions diverge
+        nes._has_backup = False
+        nes.reset()
+        nes._skip_start_screen()
+
+    def _load(self, key):
+        """Put the snapshot `key` (None for the level start) into the backup slot"""
+        self._power_cycle()
+        snapshot = {"actions": []}
+        if key is not None:
+            snapshot = self.archive[key]
+            for action in snapshot["actions"]:
+                _, _, done, info = self.env.step(int(action))
+                self.frames += 1
+                self.replay_frames += 1
+                if done:
+                    break
+            if done or info["x_pos"] != snapshot["x_pos"]:
+                # The replay did not reproduce the snapshot; drop it and use the level start
+                del self.archive[key]
+                return self._load(None)
+        self.unwrapped._backup()
+        self.slot = key
+        self.slot_actions = list(snapshot["actions"])
+        self.slot_episodes = 0
+
+    def _choose(self):
+        candidates = [key for key in self.archive if key[:2] == self.level]
+        if not candidates or self.rng.random() >= self.fraction:
+            return None
+        weights = np.array([self._weight(key) for key in candidates], dtype=np.float64)
+        return candidates[self.rng.choice(len(candidates), p=weights / weights.sum())]
+
+    def _archive(self, key, x_pos):
+        snapshot = self.archive.get(key)
+        if snapshot is not None and len(snapshot["actions"]) <= len(self.actions):
+            return  # keep the cheapest way there
+        self.archive[key] = {"actions": np.array(self.actions, dtype=np.uint8), "x_pos": x_pos}
+        if len(self.archive) > self.capacity:
+            del self.archive[min(self.archive, key=self._weight)]
+
+    def reset(self, **kwargs):
+        if self.level is not None and self.slot_episodes >= self.reuse:
+            key = self._choose()
+            if key != self.slot:
+                self._load(key)
+            else:
+                self.slot_episodes = 0
+        self.slot_episodes += 1
+        self.episodes += 1
+        self.snapshot_episodes += self.slot is not None
+        self.actions = list(self.slot_actions)
+        self.start_x = None
+        return self.env.reset(**kwargs)
+
+    def step(self, action):
+        obs, reward, done, info = self.env.step(action)
+        self.frames += 1
+        self.actions.append(action)
+
+        x_pos = info["x_pos"]
+        if self.start_x is None:
+            self.level = (info["world"], info["stage"])
+            self.start_x = self.max_x = x_pos
+        if self._bucket(x_pos) > self._bucket(self.max_x) and not self.unwrapped._is_dying:
+            self._archive((*self.level, self._bucket(x_pos)), x_pos)
+        self.max_x = max(self.max_x, x_pos)
+
+        if done:
+            self.progress += self.max_x - self.start_x
+            self.furthest = max(self.furthest, self.max_x)
+            if not info["flag_get"]:
+                self.deaths[(*self.level, self._bucket(x_pos))] += 1
+        return obs, reward, done, info
+
+    def stats(self):
+        return {
+            "episodes": self.episodes,
+            "snapshot_episodes": self.snapshot_episodes,
+            "snapshots": len(self.archive),
+            "frames": self.frames,
+            "replay_frames": self.replay_frames,
+            "x_progress": self.progress,
+            "frames_per_x": self.frames / max(1, self.progress),
+            "furthest_x": self.furthest,
+        }
+
+
+def find_curriculum(env):
+    """The SnapshotCurriculum inside a wrapped env, or None"""
+    while isinstance(env, gym.Wrapper):
+        if isinstance(env, SnapshotCurriculum):
+            return env
+        env = env.env
+    return None
@@ -4,19 +4,27 @@ from gym_super_mario_bros.actions import SIMPLE_MOVEMENT # <--- 匯入預定義
 from gym.wrappers import FrameStack, GrayScaleObservation, TransformObservation
 from nes_py.wrappers import JoypadSpace
 
+from curriculum import SnapshotCurriculum
+
 # 從您自訂的 wrappers.py 匯入
-from wrappers import CutAndScaleObservation, SkipFrame, CustomRewardMario
+from wrappers import CutAndScaleObservation, SkipFrame, CustomRewardMario, FusedObservation
 
-def build_env():
-    env = gym_super_mario_bros.make("SuperMarioBros-1-2-v0") # 或者您想用的關卡
+def build_env(fused=False, backend=None, uint8=False, curriculum=None, level="1-2"):
+    env = gym_super_mario_bros.make(f"SuperMarioBros-{level}-v0") # 關卡，例如 "1-2" 或 "4-1"
     env = JoypadSpace(env, SIMPLE_MOVEMENT) # <--- 使用 SIMPLE_MOVEMENT
+    if curriculum is not None: # 依比例從關卡中段的快照開始 episode，需在 SkipFrame 之前逐幀記錄動作
+        env = SnapshotCurriculum(env, fraction=curriculum)
 
     # --- Wrapper 順序 ---
     env = CustomRewardMario(env) # 在 SkipFrame 之前套用自訂獎勵
     env = SkipFrame(env, skip=4)
-    env = GrayScaleObservation(env, keep_dim=False)
-    env = CutAndScaleObservation(env)
-    env = TransformObservation(env, f=lambda x: x / 255.0)
-    env = FrameStack(env, num_stack=4)
+    if fused: # 單一 wrapper 完成灰階、裁切縮放與堆疊
+        env = FusedObservation(env, num_stack=4, scale=not uint8, backend=backend or "cv2")
+    else:
+        env = GrayScaleObservation(env, keep_dim=False)
+        env = CutAndScaleObservation(env, backend=backend or "skimage")
+        if not uint8: # uint8 模式下由 MarioNet 在 forward 中除以 255
+            env = TransformObservation(env, f=lambda x: x / 255.0)
+        env = FrameStack(env, num_stack=4)
 
     return env
\ No newline at end of file
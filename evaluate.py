@@ -0,0 +1,181 @@
+import argparse
+import json
+import multiprocessing as mp
+import os
+import time
+from pathlib import Path
+
+import numpy as np
+import torch
+
+from checkpoint import list_checkpoints
+from export import ExportedPolicy, ScaledQNet, load_online, load_policy
+from levels import parse_level
+from wrappers import RESIZE_BACKENDS
+
+# Per-process state of the pool workers: one env, and the policy of the last checkpoint seen
+_worker = {}
+
+
+def load_agent(path, state_dim, exploration_rate):
+    """
+    An epsilon-greedy policy with Mario's `act()`, from a training checkpoint (only
+    its online network is loaded) or from an export.py artifact.
+    """
+    path = Path(path)
+    if path.suffix == ".chkpt":
+        online, action_dim = load_online(path, state_dim)
+        return ExportedPolicy(ScaledQNet(online), {"action_dim": action_dim}, exploration_rate)
+    return load_policy(path, exploration_rate)
+
+
+def _init_worker(fused, backend, level):
+    from env import build_env
+
+    torch.set_num_threads(1)  # one core per episode; the pool provides the parallelism
+    _worker["env"] = build_env(fused=fused, backend=backend, level=level)
+
+
+def _run_episode(task):
+    """Play one episode without rendering; returns how far it got"""
+    path, episode, state_dim, exploration_rate, max_steps, seed = task
+    if _worker.get("path") != path:
+        _worker["policy"] = load_agent(path, state_dim, exploration_rate)
+        _worker["path"] = path
+    policy, env = _worker["policy"], _worker["env"]
+    # Exploration depends only on (seed, episode), not on which worker runs it
+    np.random.seed(np.random.SeedSequence([seed, episode]).generate_state(1)[0])
+
+    state = env.reset()
+    x_pos, info = 0, {}
+    for steps in range(1, max_steps + 1):
+        state, _, done, info = env.step(policy.act(state))
+        x_pos = max(x_pos, info["x_pos"])
+        if done or info["flag_get"]:
+            break
+    return {
+        "cleared": bool(info.get("flag_get", False)),
+        "x_pos": int(x_pos),
+        "score": int(info.get("score", 0)),
+        "steps": steps,
+    }
+
+
+def _describe(values):
+    if not values:
+        return None
+    values = np.asarray(values, dtype=np.float64)
+    p10, p50, p90 = np.percentile(values, [10, 50, 90])
+    return {
+        "mean": float(values.mean()),
+        "p10": float(p10),
+        "p50": float(p50),
+        "p90": float(p90),
+        "min": float(values.min()),
+        "max": float(values.max()),
+    }
+
+
+def summarize(results, wall_time):
+    cleared = [r for r in results if r["cleared"]]
+    return {
+        "episodes": len(results),
+        "clear_rate": len(cleared) / len(results),
+        "x_pos": _describe([r["x_pos"] for r in results]),
+        "score": _describe([r["score"] for r in results]),
+        "steps_to_flag": _describe([r["steps"] for r in cleared]),  # None without a clear
+        "steps": sum(r["steps"] for r in results),
+        "wall_time": wall_time,
+        "steps_per_second": sum(r["steps"] for r in results) / wall_time,
+    }
+
+
+def evaluate(
+    paths,
+    episodes=32,
+    workers=None,
+    exploration_rate=0.1,
+    max_steps=3000,
+    state_dim=(4, 21, 21),
+    seed=0,
+    fused=False,
+    backend=None,
+    level="1-2",
+):
+    """
+    Play `episodes` headless episodes of every checkpoint in `paths` across a pool of
+    `workers` processes, with `exploration_rate` fixed. Returns {path: summary}.
+    `fused`, `backend` and `level` go to build_env() and should match training.
+    """
+    workers = workers or os.cpu_count()
+    report = {}
+    with mp.get_context().Pool(
+        workers, initializer=_init_worker, initargs=(fused, backend, level)
+    ) as pool:
+        for path in paths:
+            start = time.perf_counter()
+            tasks = [
+                (str(path), e, tuple(state_dim), exploration_rate, max_steps, seed)
+                for e in range(episodes)
+            ]
+            results = pool.map(_run_episode, tasks, chunksize=1)
+            summary = report[str(path)] = summarize(results, time.perf_counter() - start)
+            print(
+                f"{path} - clear rate {summary['clear_rate']:.1%} - "
+                f"mean x_pos {summary['x_pos']['mean']:.0f} - {summary['wall_time']:.1f}s"
+            )
+    return report
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Evaluate checkpoints headlessly: clear rate, x_pos, score, steps to flag"
+    )
+    parser.add_argument(
+        "paths",
+        type=Path,
+        nargs="+",
+        help="checkpoints, export.py policies, or run directories (every checkpoint in them)",
+    )
+    parser.add_argument("--episodes", type=int, default=32, help="episodes per checkpoint")
+    parser.add_argument("--workers", type=int, default=None, help="default: one per CPU")
+    parser.add_argument("--epsilon", type=float, default=0.1, help="fixed exploration rate")
+    parser.add_argument("--max-steps", type=int, default=3000, help="agent steps per episode")
+    parser.add_argument("--state-dim", type=int, nargs=3, default=[4, 21, 21])
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", type=Path, default=None, help="also write the JSON here")
+    parser.add_argument(
+        "--fused", action="store_true", help="FusedObservation preprocessing, as in training"
+    )
+    parser.add_argument(
+        "--backend", default=None, choices=list(RESIZE_BACKENDS), help="resize backend"
+    )
+    parser.add_argument("--level", type=parse_level, default="1-2", help="level to play, e.g. 4-1")
+    args = parser.parse_args()
+
+    paths = []
+    for path in args.paths:
+        paths.extend(list_checkpoints(path) if path.is_dir() else [path])
+    if not paths:
+        raise ValueError(f"No checkpoints in {', '.join(map(str, args.paths))}")
+
+    report = evaluate(
+        paths,
+        episodes=args.episodes,
+        workers=args.workers,
+        exploration_rate=args.epsilon,
+        max_steps=args.max_steps,
+        state_dim=args.state_dim,
+        seed=args.seed,
+        fused=args.fused,
+        backend=args.backend,
+        level=args.level,
+    )
+    text = json.dumps(report, indent=2)
+    print(text)
+    if args.output is not None:
+        args.output.write_text(text)
+
+
+if __name__ == "__main__":
+    main()
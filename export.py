@@ -0,0 +1,213 @@
+import argparse
+import copy
+import json
+import sys
+import warnings
+from pathlib import Path
+
+import numpy as np
+import torch
+from torch import nn
+
+from memory import to_uint8
+from neural import MarioNet
+
+QUANTIZE_MODES = ("static", "dynamic", "none")
+
+
+class ScaledQNet(nn.Module):
+    """uint8 frame stacks in, Q-values out: MarioNet's preprocessing and online network"""
+
+    def __init__(self, net):
+        super().__init__()
+        self.net = net
+
+    def forward(self, input):
+        return self.net(input.float().div(255))
+
+
+def load_online(checkpoint, state_dim):
+    """The float32 online network of a training checkpoint, on CPU in eval mode"""
+    ckp = torch.load(checkpoint, map_location="cpu", weights_only=False)
+    weights = {
+        name[len("online.") :]: tensor
+        for name, tensor in ckp["model"].items()
+        if name.startswith("online.")
+    }
+    action_dim = list(weights.values())[-1].shape[0]  # the output layer's bias
+    online = MarioNet(state_dim, action_dim, device="cpu").online
+    online.load_state_dict(weights)
+    return online.eval(), action_dim
+
+
+def record_states(online, count, epsilon=0.1, seed=0, fused=False, backend=None, level="1-2"):
+    """
+    uint8 states visited by the float policy in build_env(), epsilon-greedy for variety.
+    `fused`, `backend` and `level` go to build_env() and should match training.
+    """
+    from env import build_env
+
+    rng = np.random.default_rng(seed)
+    env = build_env(fused=fused, backend=backend, level=level)
+    states = []
+    state = env.reset()
+    while len(states) < count:
+        states.append(to_uint8(state))
+        if rng.random() < epsilon:
+            action = int(rng.integers(env.action_space.n))
+        else:
+            with torch.no_grad():
+                q = ScaledQNet(online)(torch.from_numpy(states[-1]).unsqueeze(0))
+            action = q.argmax(1).item()
+        state, _, done, info = env.step(action)
+        if done or info["flag_get"]:
+            state = env.reset()
+    env.close()
+    return np.stack(states)
+
+
+def quantize(online, mode, calibration):
+    """
+    Trace ScaledQNet around a copy of `online`, int8-quantized by `mode`:
+    "static" quantizes convolutions and linear layers with activation ranges
+    calibrated on `calibration`, "dynamic" only the linear layers' weights.
+    """
+    model = ScaledQNet(copy.deepcopy(online)).eval()
+    example = torch.from_numpy(calibration[:1])
+    with torch.no_grad(), warnings.catch_warnings():
+        warnings.simplefilter("ignore")  # newer torch deprecates torch.ao.quantization and jit
+        if mode == "static":
+            from torch.ao.quantization import get_default_qconfig_mapping
+            from torch.ao.quantization.quantize_fx import convert_fx, prepare_fx
+
+            qconfig = get_default_qconfig_mapping(torch.backends.quantized.engine)
+            prepared = prepare_fx(model, qconfig, (example,))
+            for batch in np.array_split(calibration, max(1, len(calibration) // 256)):
+                prepared(torch.from_numpy(batch))
+            model = convert_fx(prepared)
+        elif mode == "dynamic":
+            model = torch.ao.quantization.quantize_dynamic(model, {nn.Linear}, dtype=torch.qint8)
+        return torch.jit.freeze(torch.jit.trace(model, example))
+
+
+def agreement(reference, candidate, states, batch_size=256):
+    """Fraction of `states` on which both models pick the same greedy action"""
+    same = 0
+    with torch.no_grad():
+        for batch in np.array_split(states, max(1, len(states) // batch_size)):
+            batch = torch.from_numpy(batch)
+            same += (reference(batch).argmax(1) == candidate(batch).argmax(1)).sum().item()
+    return same / len(states)
+
+
+class ExportedPolicy:
+    """
+    Epsilon-greedy actions from an exported policy, with the same `act()` as Mario.
+
+    Observations are converted to uint8 stacks, as the exported network scales them.
+    """
+
+    def __init__(self, module, meta, exploration_rate=0.0):
+        self.module = module
+        self.meta = meta
+        self.action_dim = meta["action_dim"]
+        self.exploration_rate = exploration_rate
+
+    @torch.no_grad()
+    def act(self, state):
+        if np.random.rand() < self.exploration_rate:
+            return np.random.randint(self.action_dim)
+        state = torch.from_numpy(np.ascontiguousarray(to_uint8(state))).unsqueeze(0)
+        return self.module(state).argmax(1).item()
+
+
+def load_policy(path, exploration_rate=0.0):
+    """Load an artifact written by export.py; it does not need the checkpoint or MarioNet"""
+    extra = {"meta.json": ""}
+    with warnings.catch_warnings():
+        warnings.simplefilter("ignore")
+        module = torch.jit.load(str(path), map_location="cpu", _extra_files=extra)
+    meta = json.loads(extra["meta.json"])
+    if meta["engine"] in torch.backends.quantized.supported_engines:
+        torch.backends.quantized.engine = meta["engine"]
+    return ExportedPolicy(module, meta, exploration_rate)
+
+
+def main():
+    from levels import parse_level
+    from wrappers import RESIZE_BACKENDS
+
+    parser = argparse.ArgumentParser(
+        description="Export the online network of a checkpoint as a standalone int8 policy"
+    )
+    parser.add_argument("checkpoint", type=Path)
+    parser.add_argument("--output", type=Path, default=None, help="default: <checkpoint>.int8.pt")
+    parser.add_argument("--quantize", default="static", choices=QUANTIZE_MODES)
+    parser.add_argument("--state-dim", type=int, nargs=3, default=[4, 21, 21])
+    parser.add_argument("--states", type=int, default=2000, help="states to record")
+    parser.add_argument(
+        "--states-file", type=Path, default=None, help="reuse recorded states (.npy), or save them"
+    )
+    parser.add_argument(
+        "--min-agreement", type=float, default=0.95, help="refuse to export below this"
+    )
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument(
+        "--fused", action="store_true", help="FusedObservation preprocessing, as in training"
+    )
+    parser.add_argument(
+        "--backend", default=None, choices=list(RESIZE_BACKENDS), help="resize backend"
+    )
+    parser.add_argument("--level", type=parse_level, default="1-2", help="level to record on")
+    args = parser.parse_args()
+
+    torch.manual_seed(args.seed)
+    online, action_dim = load_online(args.checkpoint, tuple(args.state_dim))
+    if args.states_file is not None and args.states_file.exists():
+        states = np.load(args.states_file)
+    else:
+        states = record_states(
+            online,
+            args.states,
+            seed=args.seed,
+            fused=args.fused,
+            backend=args.backend,
+            level=args.level,
+        )
+        if args.states_file is not None:
+            np.save(args.states_file, states)
+
+    # Calibrate on every other state, check on all of them and on the held-out half
+    policy = quantize(online, args.quantize, states[::2])
+    reference = ScaledQNet(online)
+    agree = agreement(reference, policy, states)
+    held_out = agreement(reference, policy, states[1::2])
+    print(
+        f"{args.quantize} - {len(states)} recorded states - "
+        f"greedy actions agree on {agree:.2%} ({held_out:.2%} held out)"
+    )
+    if agree < args.min_agreement:
+        print(f"Agreement below {args.min_agreement:.0%}, not exporting")
+        sys.exit(1)
+
+    output = args.output or args.checkpoint.with_suffix(".int8.pt")
+    meta = dict(
+        checkpoint=str(args.checkpoint),
+        quantize=args.quantize,
+        engine=torch.backends.quantized.engine,
+        state_dim=list(args.state_dim),
+        action_dim=action_dim,
+        agreement=agree,
+    )
+    with warnings.catch_warnings():
+        warnings.simplefilter("ignore")
+        torch.jit.save(policy, str(output), _extra_files={"meta.json": json.dumps(meta)})
+    print(
+        f"Policy saved to {output} - "
+        f"{output.stat().st_size / 2 ** 20:.2f} MiB vs "
+        f"{args.checkpoint.stat().st_size / 2 ** 20:.2f} MiB checkpoint"
+    )
+
+
+if __name__ == "__main__":
+    main()
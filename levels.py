@@ -0,0 +1,160 @@
+import numpy as np
+
+from curriculum import find_curriculum
+from metrics import LevelStats
+
+
+def parse_levels(text):
+    """'1-1,1-2,4-1' -> ['1-1', '1-2', '4-1']"""
+    levels = [level.strip() for level in text.split(",") if level.strip()]
+    for level in levels:
+        world, _, stage = level.partition("-")
+        if not (world in "12345678" and stage in "1234" and len(world) == len(stage) == 1):
+            raise ValueError(f"Not a SuperMarioBros level: {level!r}, expected e.g. 1-2")
+    return levels
+
+
+def parse_level(text):
+    """'4-1' -> '4-1', one level"""
+    levels = parse_levels(text)
+    if len(levels) != 1:
+        raise ValueError(f"Expected one SuperMarioBros level, e.g. 1-2, not {text!r}")
+    return levels[0]
+
+
+class RoundRobin:
+    """Every level in turn"""
+
+    def __init__(self, levels):
+        self.levels = levels
+        self.next = 0
+
+    def choose(self, stats, rng):
+        level = self.levels[self.next]
+        self.next = (self.next + 1) % len(self.levels)
+        return level
+
+    def update(self, level, reward, cleared):
+        pass
+
+
+class ClearRateWeighted:
+    """Levels in proportion to how often their recent episodes fail, plus `floor`"""
+
+    def __init__(self, levels, floor=0.05):
+        self.levels = levels
+        self.floor = floor
+
+    def choose(self, stats, rng):
+        weights = np.array([1.0 - stats[level].clear_rate + self.floor for level in self.levels])
+        return self.levels[rng.choice(len(self.levels), p=weights / weights.sum())]
+
+    def update(self, level, reward, cleared):
+        pass
+
+
+class LearningProgress:
+    """
+    Levels in proportion to their learning progress: the gap between a fast and a slow
+    moving average of the episode reward, which opens up whenever the reward climbs or
+    drops. An `explore` fraction of the episodes picks a level uniformly, so stalled
+    levels are still revisited.
+    """
+
+    def __init__(self, levels, fast=0.1, slow=0.01, explore=0.2):
+        self.levels = levels
+        self.fast_rate = fast
+        self.slow_rate = slow
+        self.explore = explore
+        self.fast = {}
+        self.slow = {}
+
+    def choose(self, stats, rng):
+        progress = np.array(
+            [abs(self.fast.get(level, 0.0) - self.slow.get(level, 0.0)) for level in self.levels]
+        )
+        if rng.random() < self.explore or progress.sum() == 0:
+            return self.levels[rng.integers(len(self.levels))]
+        return self.levels[rng.choice(len(self.levels), p=progress / progress.sum())]
+
+    def update(self, level, reward, cleared):
+        if level not in self.fast:
+            self.fast[level] = self.slow[level] = reward
+        self.fast[level] += self.fast_rate * (reward - self.fast[level])
+        self.slow[level] += self.slow_rate * (reward - self.slow[level])
+
+
+LEVEL_POLICIES = {
+    "round-robin": RoundRobin,
+    "clear-rate": ClearRateWeighted,
+    "progress": LearningProgress,
+}
+
+
+class LevelScheduler:
+    """
+    Train on several levels from one env-like object.
+
+    An env is built once per level with `env_fn(level=...)` and kept, so switching
+    levels only costs that env's `reset()`. Each `reset()` lets `policy` pick the
+    level of the next episode; levels that were never played go first. Episode reward,
+    length and clears are tracked per level over the last `window` episodes, and
+    `info["level"]` says which level a step came from.
+    """
+
+    def __init__(self, env_fn, levels, policy="round-robin", window=100, seed=None):
+        if policy not in LEVEL_POLICIES:
+            raise ValueError(f"Unknown level policy {policy!r}, expected {list(LEVEL_POLICIES)}")
+        if not levels:
+            raise ValueError("LevelScheduler needs at least one level")
+        self.levels = list(levels)
+        self.envs = {level: env_fn(level=level) for level in self.levels}
+        self.policy = LEVEL_POLICIES[policy](self.levels)
+        self.stats = {level: LevelStats(window) for level in self.levels}
+        self.started = {level: 0 for level in self.levels}  # episodes, finished or not
+        self.rng = np.random.default_rng(seed)
+
+        first = self.envs[self.levels[0]]
+        self.observation_space = first.observation_space
+        self.action_space = first.action_space
+        self.level = None
+        self.env = None
+        self.episode_reward = 0.0
+        self.episode_length = 0
+
+    def _choose(self):
+        unplayed = [level for level in self.levels if self.started[level] == 0]
+        if unplayed:
+            return unplayed[0]
+        return self.policy.choose(self.stats, self.rng)
+
+    def reset(self, **kwargs):
+        self.level = self._choose()
+        self.env = self.envs[self.level]
+        self.started[self.level] += 1
+        self.episode_reward = 0.0
+        self.episode_length = 0
+        return self.env.reset(**kwargs)
+
+    def step(self, action):
+        obs, reward, done, info = self.env.step(action)
+        self.episode_reward += reward
+        self.episode_length += 1
+        info["level"] = self.level
+        if done or info["flag_get"]:
+            cleared = bool(info["flag_get"])
+            self.stats[self.level].add(self.episode_reward, self.episode_length, cleared)
+            self.policy.update(self.level, self.episode_reward, cleared)
+        return obs, reward, done, info
+
+    def curricula(self):
+        """The SnapshotCurriculum of each level's env, for the levels that have one"""
+        curricula = {level: find_curriculum(env) for level, env in self.envs.items()}
+        return {level: curriculum for level, curriculum in curricula.items() if curriculum}
+
+    def render(self, mode="human"):
+        return self.env.render(mode=mode)
+
+    def close(self):
+        for env in self.envs.values():
+            env.close()
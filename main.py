@@ -11,6 +11,7 @@ from nes_py.wrappers import JoypadSpace
 
 from metrics import MetricLogger
 from agent import Mario
+from checkpoint import latest_checkpoint
 from wrappers import ResizeObservation, SkipFrame
 
 # Initialize Super Mario environment
@@ -34,10 +35,14 @@ env = FrameStack(env, num_stack=4)
 
 env.reset()
 
-save_dir = Path('checkpoints') / datetime.datetime.now().strftime('%Y-%m-%dT%H-%M-%S')
-save_dir.mkdir(parents=True)
-
-checkpoint = None # Path('checkpoints/2020-10-21T18-25-27/mario.chkpt')
+resume_dir = None # Path('checkpoints/2020-10-21T18-25-27') to resume from its latest checkpoint
+if resume_dir is not None:
+    save_dir = resume_dir
+    checkpoint = latest_checkpoint(resume_dir)
+else:
+    save_dir = Path('checkpoints') / datetime.datetime.now().strftime('%Y-%m-%dT%H-%M-%S')
+    save_dir.mkdir(parents=True)
+    checkpoint = None # Path('checkpoints/2020-10-21T18-25-27/mario.chkpt')
 mario = Mario(state_dim=(4, 84, 84), action_dim=env.action_space.n, save_dir=save_dir, checkpoint=checkpoint)
 
 logger = MetricLogger(save_dir)
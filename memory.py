@@ -0,0 +1,718 @@
+import atexit
+import copy
+import json
+import os
+import queue
+import threading
+import time
+from collections import deque
+from pathlib import Path
+
+import numpy as np
+import torch
+
+
+def to_uint8(observation):
+    """
+    Convert an observation to a uint8 array.
+
+    Observations coming out of `build_env()` are scaled to [0, 1] floats, but they
+    originate from uint8 pixels, so rounding `x * 255` recovers them exactly.
+    """
+    observation = np.asarray(observation)
+    if observation.dtype == np.uint8:
+        return observation
+    return np.rint(observation * 255.0).astype(np.uint8)
+
+
+class ReplayStorage:
+    """
+    Shared plumbing of the replay buffers below: `arrays` names the per-slot
+    arrays and `counters` the scalars that say which slots are in use.
+    """
+
+    arrays = ()
+    counters = ("ptr", "size")
+    fill = {"steps": 1}  # initial value of arrays that do not start out as zeros
+
+    def _allocate(self, name, shape, dtype):
+        fill = self.fill.get(name, 0)
+        if fill == 0:
+            return np.zeros(shape, dtype=dtype)  # calloc: pages are committed as they are written
+        return np.full(shape, fill, dtype=dtype)
+
+    def __len__(self):
+        return self.size
+
+    @property
+    def nbytes(self):
+        return sum(getattr(self, name).nbytes for name in self.arrays)
+
+    def state_dict(self):
+        """
+        The arrays (by reference, like `nn.Module.state_dict()`) and a copy of the
+        counters, e.g. for `checkpoint.snapshot()` to copy into a checkpoint
+        """
+        state = {name: getattr(self, name) for name in self.arrays}
+        state.update({name: copy.deepcopy(getattr(self, name)) for name in self.counters})
+        return state
+
+    def load_state_dict(self, state):
+        for name in self.arrays:
+            if name in state:  # arrays added later keep their initial fill
+                getattr(self, name)[:] = state[name]
+        for name in self.counters:
+            setattr(self, name, state[name])
+
+    def sample(self, batch_size):
+        """
+        Sample a batch of transitions uniformly (with replacement)
+        """
+        return self.gather(self.sample_indices(batch_size))
+
+
+class ReplayBuffer(ReplayStorage):
+    """
+    Replay memory backed by contiguous preallocated arrays.
+
+    Every field lives in its own ring buffer (uint8 observations, int64 actions,
+    float32 rewards, bool dones, uint8 no. of steps the transition spans), so
+    inserting a transition is a handful of slice writes and sampling a batch is one
+    fancy-index per field.
+    """
+
+    arrays = ("states", "next_states", "actions", "rewards", "dones", "steps")
+
+    def __init__(self, capacity, state_dim, device="cpu"):
+        self.capacity = int(capacity)
+        self.state_dim = tuple(state_dim)
+        self.device = device
+
+        self.states = self._allocate("states", (self.capacity, *self.state_dim), np.uint8)
+        self.next_states = self._allocate(
+            "next_states", (self.capacity, *self.state_dim), np.uint8
+        )
+        self.actions = self._allocate("actions", (self.capacity,), np.int64)
+        self.rewards = self._allocate("rewards", (self.capacity,), np.float32)
+        self.dones = self._allocate("dones", (self.capacity,), np.bool_)
+        self.steps = self._allocate("steps", (self.capacity,), np.uint8)
+
+        self.ptr = 0  # slot the next transition is written to
+        self.size = 0  # no. of valid transitions
+
+    def add(self, state, next_state, action, reward, done, steps=1, stream=0):
+        """
+        Store one transition, overwriting the oldest one once the buffer is full.
+        `next_state` is `steps` steps after `state` and `reward` their discounted
+        return. Whole stacks are stored, so `stream` is not needed.
+
+        Outputs:
+        slot (int): Index the transition was written to
+        """
+        slot = self.ptr
+        self.states[slot] = to_uint8(state)
+        self.next_states[slot] = to_uint8(next_state)
+        self.actions[slot] = action
+        self.rewards[slot] = reward
+        self.dones[slot] = done
+        self.steps[slot] = steps
+
+        self.ptr = (self.ptr + 1) % self.capacity
+        self.size = min(self.size + 1, self.capacity)
+        return slot
+
+    def valid(self, idx):
+        return idx < self.size
+
+    def sample_indices(self, batch_size):
+        return np.random.randint(0, self.size, size=batch_size)
+
+    def gather(self, idx):
+        """
+        Gather the transitions at `idx` as torch tensors on `self.device`
+        """
+        # Frames stay uint8 all the way to MarioNet, which scales them
+        state = torch.from_numpy(self.states[idx]).to(self.device)
+        next_state = torch.from_numpy(self.next_states[idx]).to(self.device)
+        action = torch.from_numpy(self.actions[idx]).to(self.device)
+        reward = torch.from_numpy(self.rewards[idx]).to(self.device)
+        done = torch.from_numpy(self.dones[idx]).to(self.device)
+        steps = torch.from_numpy(self.steps[idx]).to(self.device)
+        return state, next_state, action, reward, done, steps
+
+
+class FrameReplayBuffer(ReplayStorage):
+    """
+    Replay memory that stores every frame once instead of eight times.
+
+    `FrameStack` makes consecutive observations share all but their newest frame,
+    so each slot here holds a single (h, w) frame plus the transition that ended on
+    it, and `prev` points at the slot holding the frame before it in the same
+    episode. The first frame of an episode points at itself, which reproduces the
+    padding `FrameStack` applies after `reset()`, and carries no transition.
+    Because episodes are linked by pointers rather than by position, several
+    environments can write interleaved streams into the same buffer.
+
+    `stamp` records when each slot was last written; a stack is only sampled while
+    none of its frames has been overwritten by a newer one.
+
+    An n-step transition ends on the newest frame of its `next_state`, and its
+    `state` is the stack `steps` frames further back in the same chain, so `steps`
+    can be at most the stack size. At the end of an episode the remaining n-step
+    transitions all end on the last frame; each of them gets its own copy of it.
+    """
+
+    arrays = ("frames", "actions", "rewards", "dones", "steps", "transitions", "prev", "stamp")
+    counters = ("ptr", "size", "written", "last_slots")
+
+    def __init__(self, capacity, state_dim, device="cpu"):
+        self.capacity = int(capacity)
+        self.state_dim = tuple(state_dim)
+        self.history = self.state_dim[0]
+        self.device = device
+
+        self.frames = self._allocate("frames", (self.capacity, *self.state_dim[1:]), np.uint8)
+        self.actions = self._allocate("actions", (self.capacity,), np.int64)
+        self.rewards = self._allocate("rewards", (self.capacity,), np.float32)
+        self.dones = self._allocate("dones", (self.capacity,), np.bool_)
+        self.steps = self._allocate("steps", (self.capacity,), np.uint8)
+        self.transitions = self._allocate("transitions", (self.capacity,), np.bool_)
+        self.prev = self._allocate("prev", (self.capacity,), np.int64)
+        self.stamp = self._allocate("stamp", (self.capacity,), np.int64)
+
+        self.ptr = 0
+        self.size = 0
+        self.written = 0  # no. of frames written so far, the next stamp
+        self.last_slots = {}  # stream -> (slot, stamp) of its newest frame
+
+    def _write_frame(self, frame, prev):
+        slot = self.ptr
+        self.frames[slot] = frame
+        self.prev[slot] = slot if prev is None else prev
+        self.stamp[slot] = self.written
+        self.transitions[slot] = False
+        self.dones[slot] = False
+        self.steps[slot] = 1
+        self.written += 1
+        self.ptr = (self.ptr + 1) % self.capacity
+        self.size = min(self.size + 1, self.capacity)
+        return slot
+
+    def _chain(self, idx, length):
+        """Slots of the `length` frames ending on each slot in `idx`, oldest first"""
+        slots = [np.asarray(idx)]
+        for _ in range(length - 1):
+            slots.append(self.prev[slots[-1]])
+        return np.stack(slots[::-1], axis=-1)
+
+    def _continues(self, state, next_state, steps, stream):
+        """
+        Slot to link the newest frame of `next_state` to when the transition continues
+        the newest chain of `stream`, or None
+        """
+        if stream not in self.last_slots:
+            return None
+        slot, stamp = self.last_slots[stream]
+        if self.stamp[slot] != stamp:
+            return None
+        back = self.frames[self._chain(slot, self.history + steps)]
+        if (
+            not self.dones[slot]
+            and np.array_equal(state, back[1 : self.history + 1])
+            and np.array_equal(next_state[:-1], back[steps + 1 :])
+        ):
+            return slot  # one frame further
+        if np.array_equal(state, back[: self.history]) and np.array_equal(
+            next_state, back[steps:]
+        ):
+            return self.prev[slot]  # same newest frame, n-step transitions ending an episode
+        return None
+
+    def add(self, state, next_state, action, reward, done, steps=1, stream=0):
+        """
+        Store one transition whose `next_state` is `steps` steps after `state`. A
+        transition that does not continue the last one of the same `stream` starts a
+        new episode and its distinct frames are written first.
+
+        Outputs:
+        slot (int): Index of the slot holding the transition
+        """
+        if not 1 <= steps <= self.history:
+            raise ValueError(f"FrameReplayBuffer stores 1 to {self.history} steps, not {steps}")
+        state = to_uint8(state)
+        next_state = to_uint8(next_state)
+
+        prev = self._continues(state, next_state, steps, stream)
+        if prev is None:
+            # Leading repeats are the FrameStack padding of the first frame
+            first = 0
+            while first + 1 < self.history and np.array_equal(state[first + 1], state[0]):
+                first += 1
+            for frame in state[first:]:
+                prev = self._write_frame(frame, prev)
+            for frame in next_state[self.history - steps : -1]:
+                prev = self._write_frame(frame, prev)
+
+        slot = self._write_frame(next_state[-1], prev)
+        self.actions[slot] = action
+        self.rewards[slot] = reward
+        self.dones[slot] = done
+        self.steps[slot] = steps
+        self.transitions[slot] = True
+        self.last_slots[stream] = (slot, int(self.stamp[slot]))
+        return slot
+
+    def _span(self, idx):
+        """Chain covering the longest transition in `idx`, and the steps of each"""
+        steps = self.steps[idx].astype(np.int64)
+        length = self.history + int(steps.max(initial=1))
+        return self._chain(idx, length), steps
+
+    def valid(self, idx):
+        """Whether the slots in `idx` hold a transition whose frames are all retained"""
+        chain, steps = self._span(idx)
+        # Only the last history + steps frames of each chain belong to its transition
+        needed = np.arange(chain.shape[-1]) >= chain.shape[-1] - self.history - steps[..., None]
+        fresh = self.stamp[chain] <= self.stamp[idx][..., None]
+        intact = (fresh | ~needed).all(axis=-1)
+        return (idx < self.size) & self.transitions[idx] & intact
+
+    def sample_indices(self, batch_size):
+        idx = np.random.randint(0, self.size, size=batch_size)
+        invalid = ~self.valid(idx)
+        while invalid.any():
+            idx[invalid] = np.random.randint(0, self.size, size=int(invalid.sum()))
+            invalid = ~self.valid(idx)
+        return idx
+
+    def gather(self, idx):
+        # The next_state stack ends the chain and the state stack starts `steps` earlier
+        chain, steps = self._span(idx)
+        frames = self.frames[chain]
+        start = chain.shape[-1] - self.history - steps
+        rows = np.arange(len(idx))[:, None]
+        state = torch.from_numpy(frames[rows, start[:, None] + np.arange(self.history)])
+        next_state = torch.from_numpy(frames[:, -self.history :])
+        action = torch.from_numpy(self.actions[idx]).to(self.device)
+        reward = torch.from_numpy(self.rewards[idx]).to(self.device)
+        done = torch.from_numpy(self.dones[idx]).to(self.device)
+        steps = torch.from_numpy(self.steps[idx]).to(self.device)
+        return state.to(self.device), next_state.to(self.device), action, reward, done, steps
+
+
+class NStepAccumulator:
+    """
+    Turn one-step transitions into n-step ones, per stream.
+
+    The last `n` transitions of each stream wait in a window while later rewards are
+    added to their discounted returns. Once the window is full the oldest leaves as
+    (state, state n steps later, action, return, done, n). When an episode ends,
+    every waiting transition leaves with its return up to the end and the no. of
+    steps it actually covers; a stream that restarts without a terminal transition
+    flushes the same way, but not done, so the target still bootstraps.
+    """
+
+    def __init__(self, n, gamma):
+        self.n = n
+        self.gamma = gamma
+        self.windows = {}  # stream -> deque of [state, action, return, steps]
+        self.last_next_states = {}
+
+    def _flush(self, window, next_state, done):
+        out = [(s, next_state, a, r, done, k) for s, a, r, k in window]
+        window.clear()
+        return out
+
+    def push(self, state, next_state, action, reward, done, stream=0):
+        """
+        Outputs:
+        transitions (list): n-step (state, next_state, action, reward, done, steps)
+        tuples that are complete
+        """
+        window = self.windows.setdefault(stream, deque())
+        out = []
+        if window:
+            last = self.last_next_states[stream]
+            if state is not last and not np.array_equal(state, last):
+                out += self._flush(window, last, done=False)
+
+        for item in window:
+            item[2] += self.gamma ** item[3] * reward
+            item[3] += 1
+        window.append([state, action, float(reward), 1])
+        self.last_next_states[stream] = next_state
+
+        if done:
+            out += self._flush(window, next_state, done=True)
+        elif len(window) == self.n:
+            s, a, r, k = window.popleft()
+            out.append((s, next_state, a, r, False, k))
+        return out
+
+
+class MemmapMixin:
+    """
+    Keep a replay buffer's arrays in `np.memmap` files under `directory`.
+
+    Each field gets its own `<name>.dat` file and the write pointer lives in
+    `meta.json`, so capacity is bounded by disk rather than RAM and an existing
+    buffer is reopened where it left off after a restart. Data is flushed, then the
+    metadata atomically replaced, every `flush_every` insertions.
+    """
+
+    def __init__(self, capacity, state_dim, device="cpu", directory=None, flush_every=10000):
+        if directory is None:
+            raise ValueError(f"{type(self).__name__} needs a directory to store its files in")
+        self.directory = Path(directory)
+        self.directory.mkdir(parents=True, exist_ok=True)
+        self.meta_path = self.directory / "meta.json"
+        self.flush_every = flush_every
+        self._unflushed = 0
+
+        meta = None
+        if self.meta_path.exists():
+            meta = json.loads(self.meta_path.read_text())
+            expected = dict(kind=type(self).__name__, capacity=int(capacity), state_dim=list(state_dim))
+            found = {key: meta.get(key) for key in expected}
+            if found != expected:
+                raise ValueError(
+                    f"Replay in {self.directory} was created as {found}, cannot reopen as {expected}"
+                )
+        self._reopen = meta is not None
+
+        super().__init__(capacity, state_dim, device=device)
+        if meta is not None:
+            for name in self.counters:
+                setattr(self, name, meta["counters"][name])
+            print(f"Reopened replay at {self.directory} with {len(self)} transitions")
+        atexit.register(self.flush)
+
+    def _allocate(self, name, shape, dtype):
+        path = self.directory / f"{name}.dat"
+        if self._reopen and path.exists():
+            return np.memmap(path, dtype=dtype, mode="r+", shape=shape)
+        array = np.memmap(path, dtype=dtype, mode="w+", shape=shape)  # sparse, reads as zeros
+        if self.fill.get(name, 0):  # also arrays added since the replay was created
+            array[:] = self.fill[name]
+        return array
+
+    def _arrays(self):
+        return [v for v in vars(self).values() if isinstance(v, np.memmap)]
+
+    def flush(self):
+        for array in self._arrays():
+            array.flush()
+        meta = dict(
+            kind=type(self).__name__,
+            capacity=self.capacity,
+            state_dim=list(self.state_dim),
+            counters={name: getattr(self, name) for name in self.counters},
+        )
+        tmp_path = self.meta_path.with_suffix(".tmp")
+        tmp_path.write_text(json.dumps(meta))
+        os.replace(tmp_path, self.meta_path)
+        self._unflushed = 0
+
+    def add(self, *transition, **kwargs):
+        slot = super().add(*transition, **kwargs)
+        self._unflushed += 1
+        if self._unflushed >= self.flush_every:
+            self.flush()
+        return slot
+
+    def state_dict(self):
+        # The arrays already persist in their own files, only the counters are copied
+        self.flush()
+        return {name: copy.deepcopy(getattr(self, name)) for name in self.counters}
+
+    def load_state_dict(self, state):
+        for name in self.counters:
+            setattr(self, name, state[name])
+
+    def sample_indices(self, batch_size):
+        # Ascending slots turn random reads into a forward sweep over the files
+        return np.sort(super().sample_indices(batch_size))
+
+
+class MemmapReplayBuffer(MemmapMixin, ReplayBuffer):
+    pass
+
+
+class MemmapFrameReplayBuffer(MemmapMixin, FrameReplayBuffer):
+    # Episodes never continue across a restart, so `last_slots` is not persisted
+    counters = ("ptr", "size", "written")
+
+
+class SumTree:
+    """
+    Array-based binary sum tree over `capacity` leaf priorities.
+
+    The root is `tree[1]`, the children of node `i` are `2i` and `2i + 1`, and leaf
+    `j` sits at `j + self.leaves`. Updates and lookups walk one level at a time for
+    the whole batch, so both cost O(log n) vectorized steps.
+    """
+
+    def __init__(self, capacity):
+        self.capacity = int(capacity)
+        self.leaves = 1 << max(self.capacity - 1, 1).bit_length()
+        self.depth = self.leaves.bit_length() - 1
+        self.tree = np.zeros(2 * self.leaves, dtype=np.float64)
+
+    @property
+    def total(self):
+        return self.tree[1]
+
+    def get(self, idx):
+        return self.tree[idx + self.leaves]
+
+    def update(self, idx, priorities):
+        pos = np.asarray(idx, dtype=np.int64) + self.leaves
+        self.tree[pos] = priorities
+        for _ in range(self.depth):
+            pos //= 2  # duplicate parents just write the same sum twice
+            self.tree[pos] = self.tree[2 * pos] + self.tree[2 * pos + 1]
+
+    def find(self, values):
+        """Leaf index whose prefix-sum interval contains each of `values`"""
+        values = np.array(values, dtype=np.float64)
+        pos = np.ones(len(values), dtype=np.int64)
+        for _ in range(self.depth):
+            left = 2 * pos
+            left_sum = self.tree[left]
+            go_right = values >= left_sum
+            values -= np.where(go_right, left_sum, 0.0)
+            pos = left + go_right
+        return np.minimum(pos - self.leaves, self.capacity - 1)
+
+
+class PrioritizedReplay:
+    """
+    Proportional prioritized experience replay (Schaul et al., 2016) on top of any
+    storage above.
+
+    Transitions are drawn with probability p_i^alpha / sum_k p_k^alpha, where p_i is
+    the last absolute TD error seen for them, and come with importance-sampling
+    weights (N * P(i))^-beta normalized by their maximum. New transitions get the
+    largest priority seen so far so that each is replayed at least once. `beta`
+    is annealed linearly to 1 over `beta_steps` calls to `sample_prioritized`.
+    """
+
+    def __init__(self, storage, alpha=0.6, beta=0.4, beta_steps=1e6, eps=1e-6):
+        self.storage = storage
+        self.device = storage.device
+        self.alpha = alpha
+        self.beta = beta
+        self.beta_increment = (1.0 - beta) / beta_steps
+        self.eps = eps
+
+        self.tree = SumTree(storage.capacity)
+        self.max_priority = 1.0
+        # Count of add() calls, and its value when each slot was last written, so priority
+        # updates computed from a batch sampled before a slot was overwritten can be dropped
+        self.writes = 0
+        self.written = np.zeros(storage.capacity, dtype=np.int64)
+        if len(storage) > 0:  # reopened on-disk storage: start from uniform priorities
+            self.tree.update(np.arange(len(storage)), self.max_priority)
+
+    def __len__(self):
+        return len(self.storage)
+
+    @property
+    def capacity(self):
+        return self.storage.capacity
+
+    @property
+    def nbytes(self):
+        return self.storage.nbytes + self.tree.tree.nbytes
+
+    def add(self, *transition, **kwargs):
+        slot = self.storage.add(*transition, **kwargs)
+        self.tree.update([slot], self.max_priority)
+        self.writes += 1
+        self.written[slot] = self.writes
+        return slot
+
+    def _draw(self, batch_size):
+        # One draw per equal-mass segment keeps the batch spread over the distribution
+        segment = self.tree.total / batch_size
+        values = (np.arange(batch_size) + np.random.rand(batch_size)) * segment
+        return self.tree.find(values)
+
+    def sample_indices(self, batch_size):
+        idx = self._draw(batch_size)
+        invalid = ~self.storage.valid(idx) | (self.tree.get(idx) <= 0)
+        while invalid.any():
+            # Slots the storage can no longer reconstruct are dropped for good
+            self.tree.update(idx[invalid], 0.0)
+            idx[invalid] = self.tree.find(np.random.rand(int(invalid.sum())) * self.tree.total)
+            invalid = ~self.storage.valid(idx) | (self.tree.get(idx) <= 0)
+        return idx
+
+    def sample_prioritized(self, batch_size):
+        """
+        Outputs:
+        batch (tuple): (state, next_state, action, reward, done, steps) as in `sample()`;
+        `steps` is the no. of env steps each n-step transition spans, so its bootstrap
+        from `next_state` is discounted by gamma ** steps
+        idx (np.ndarray): Slots of the sampled transitions, for `update_priorities()`
+        weights (torch.Tensor): Importance-sampling weight of each transition
+        """
+        idx = self.sample_indices(batch_size)
+        probs = self.tree.get(idx) / self.tree.total
+        weights = (len(self) * probs) ** -self.beta
+        weights /= weights.max()
+        self.beta = min(1.0, self.beta + self.beta_increment)
+        weights = torch.as_tensor(weights, dtype=torch.float32, device=self.device)
+        return self.storage.gather(idx), idx, weights
+
+    def sample(self, batch_size):
+        return self.storage.gather(self.sample_indices(batch_size))
+
+    def update_priorities(self, idx, td_errors, sampled_at=None):
+        """
+        Set the priorities of the slots `idx` from their TD errors. With `sampled_at`,
+        the value of `writes` when the batch was sampled, slots written since then
+        hold other transitions and keep their priority. Returns the no. of those.
+        """
+        if sampled_at is not None:
+            fresh = self.written[idx] <= sampled_at
+            idx, td_errors = np.asarray(idx)[fresh], np.asarray(td_errors)[fresh]
+            if len(idx) == 0:
+                return len(fresh)
+        priorities = (np.abs(td_errors) + self.eps) ** self.alpha
+        self.tree.update(idx, priorities)
+        self.max_priority = max(self.max_priority, float(priorities.max()))
+        return 0 if sampled_at is None else int((~fresh).sum())
+
+    def state_dict(self):
+        return dict(
+            storage=self.storage.state_dict(),
+            tree=self.tree.tree,
+            max_priority=self.max_priority,
+            beta=self.beta,
+        )
+
+    def load_state_dict(self, state):
+        self.storage.load_state_dict(state["storage"])
+        self.tree.tree[:] = state["tree"]
+        self.max_priority = state["max_priority"]
+        self.beta = state["beta"]
+
+
+class BatchPrefetcher:
+    """
+    Sample batches from `memory` in a background thread, up to `depth` ahead of the
+    learner.
+
+    The thread samples and gathers whole batches, so `get()` only takes a ready one
+    off the queue. Writes from `cache()` must go through `add()` (or hold `lock`):
+    a batch is sampled and copied out of the arrays under the lock, so it never sees
+    a half-written transition. A batch may be up to `depth` batches older than the
+    newest transitions. With `prioritized`, batches come from `sample_prioritized()`
+    and `update_priorities()` takes the lock as well and skips the slots `cache()`
+    has overwritten since the batch was sampled, so a stale TD error never replaces
+    the priority of a new transition. Sampling starts at the first `get()`, so the
+    replay can be filled up to the burn-in first.
+    """
+
+    def __init__(self, memory, batch_size, depth=2, prioritized=False):
+        self.memory = memory
+        self.batch_size = batch_size
+        self.prioritized = prioritized
+        self.lock = threading.Lock()
+        self.queue = queue.Queue(maxsize=depth)
+        self.stopped = threading.Event()
+        self.thread = None
+
+        # Since the last stats(): batches taken, queue depth summed over them, seconds
+        # get() spent waiting, no. of times it found the queue empty and priority
+        # updates skipped because their slot was overwritten
+        self.batches = 0
+        self.depth_sum = 0
+        self.wait = 0.0
+        self.stalls = 0
+        self.stale = 0
+
+    def add(self, *transition, **kwargs):
+        with self.lock:
+            return self.memory.add(*transition, **kwargs)
+
+    def update_priorities(self, idx, td_errors, sampled_at):
+        with self.lock:
+            self.stale += self.memory.update_priorities(idx, td_errors, sampled_at)
+
+    def _sample(self):
+        with self.lock:
+            if self.prioritized:
+                batch, idx, weights = self.memory.sample_prioritized(self.batch_size)
+                return batch, idx, weights, self.memory.writes
+            return self.memory.sample(self.batch_size), None, None, None
+
+    def _run(self):
+        try:
+            while not self.stopped.is_set():
+                item = self._sample()
+                while not self.stopped.is_set():
+                    try:
+                        self.queue.put(item, timeout=0.1)
+                        break
+                    except queue.Full:
+                        pass
+        except Exception as e:  # hand the error to the learner instead of dying silently
+            self.queue.put(e)
+
+    def get(self):
+        """
+        Outputs:
+        batch (tuple): As `memory.sample()` returns it
+        idx, weights: As `sample_prioritized()` returns them, None without `prioritized`
+        sampled_at: `memory.writes` when the batch was sampled, for `update_priorities()`
+        """
+        if self.thread is None:
+            self.thread = threading.Thread(target=self._run, name="prefetcher", daemon=True)
+            self.thread.start()
+            atexit.register(self.close)
+        depth = self.queue.qsize()
+        start = time.perf_counter()
+        item = self.queue.get()
+        self.wait += time.perf_counter() - start
+        self.batches += 1
+        self.depth_sum += depth
+        self.stalls += depth == 0
+        if isinstance(item, Exception):
+            raise item
+        return item
+
+    def stats(self):
+        """Mean queue depth found by get(), its wait, stalls and stale updates since stats()"""
+        stats = dict(
+            batches=self.batches,
+            queue_depth=self.depth_sum / self.batches if self.batches else 0.0,
+            wait=self.wait,
+            stalls=self.stalls,
+            stale_priorities=self.stale,
+        )
+        self.batches = self.depth_sum = self.stalls = self.stale = 0
+        self.wait = 0.0
+        return stats
+
+    def close(self):
+        self.stopped.set()
+        if self.thread is not None and self.thread.is_alive():
+            self.thread.join()
+
+
+REPLAY_BUFFERS = {
+    "array": ReplayBuffer,
+    "frames": FrameReplayBuffer,
+    "memmap": MemmapReplayBuffer,
+    "memmap-frames": MemmapFrameReplayBuffer,
+}
+
+
+def build_replay(kind, capacity, state_dim, device="cpu", directory=None):
+    if kind not in REPLAY_BUFFERS:
+        raise ValueError(f"Unknown replay kind {kind!r}, expected one of {list(REPLAY_BUFFERS)}")
+    if kind.startswith("memmap"):
+        return REPLAY_BUFFERS[kind](capacity, state_dim, device=device, directory=directory)
+    return REPLAY_BUFFERS[kind](capacity, state_dim, device=device)
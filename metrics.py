@@ -1,40 +1,211 @@
+import atexit
+import csv
 import datetime
+import json
 import time
+from collections import defaultdict
 
 import numpy as np
 
+from plotting import PlotRenderer
+
+# Phases of the training loop, then the ones inside Mario.learn()
+LOOP_PHASES = ("act", "env", "cache", "learn", "log")
+LEARN_PHASES = ("sample", "forward", "backward", "optimizer", "sync", "save")
+
+
+class _Phase:
+    __slots__ = ("timer", "name", "start")
+
+    def __init__(self, timer, name):
+        self.timer = timer
+        self.name = name
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+
+    def __exit__(self, *exc):
+        self.timer.totals[self.name] += time.perf_counter() - self.start
+        self.timer.sampled[self.name] += 1
+
+
+class _Skip:
+    def __enter__(self):
+        pass
+
+    def __exit__(self, *exc):
+        pass
+
+
+class PhaseTimer:
+    """
+    Accumulate wall time per named phase with the monotonic `time.perf_counter`.
+
+    `with timer.phase("env"): ...` counts every call but times only every
+    `sample_every`-th one, starting with the first; `pop()` scales the sampled time
+    up to all calls and starts a new interval.
+    """
+
+    def __init__(self, sample_every=1):
+        self.sample_every = sample_every
+        self.counts = defaultdict(int)  # calls since pop()
+        self.sampled = defaultdict(int)  # timed calls since pop()
+        self.totals = defaultdict(float)  # seconds of the timed calls since pop()
+        self.phases = {}
+        self.skip = _Skip()
+
+    def phase(self, name):
+        self.counts[name] += 1
+        if (self.counts[name] - 1) % self.sample_every:  # the first call is always timed
+            return self.skip
+        if name not in self.phases:
+            self.phases[name] = _Phase(self, name)
+        return self.phases[name]
+
+    def pop(self):
+        """Estimated seconds and no. of calls per phase since the last pop()"""
+        seconds = {
+            name: self.totals[name] * count / self.sampled[name]
+            for name, count in self.counts.items()
+            if self.sampled[name]
+        }
+        counts = dict(self.counts)
+        self.counts.clear()
+        self.sampled.clear()
+        self.totals.clear()
+        return seconds, counts
+
+
+class RollingMean:
+    """
+    Mean of the last `window` values in O(1) per value: a fixed-size ring buffer and
+    a running sum, recomputed once per lap so float error does not build up.
+    """
+
+    def __init__(self, window=100):
+        self.values = np.zeros(window)
+        self.sum = 0.0
+        self.count = 0
+        self.index = 0
+
+    def add(self, value):
+        self.sum += value - self.values[self.index]
+        self.values[self.index] = value
+        self.index = (self.index + 1) % len(self.values)
+        self.count = min(self.count + 1, len(self.values))
+        if self.index == 0:
+            self.sum = float(self.values.sum())
+
+    @property
+    def mean(self):
+        return self.sum / self.count if self.count else float("nan")
+
+
+class LevelStats:
+    """Episodes played on one level; reward, length and clear rate over the last `window`"""
+
+    def __init__(self, window=100):
+        self.episodes = 0
+        self.rewards = RollingMean(window)
+        self.lengths = RollingMean(window)
+        self.clears = RollingMean(window)
+
+    def add(self, reward, length, cleared):
+        self.episodes += 1
+        self.rewards.add(reward)
+        self.lengths.add(length)
+        self.clears.add(float(cleared))
+
+    @property
+    def clear_rate(self):
+        return self.clears.mean if self.clears.count else 0.0
+
 
 class MetricLogger:
-    def __init__(self, save_dir):
+    """
+    Log 100-episode moving averages every record() to the fixed-width `log` and to
+    `metrics.jsonl` (or `metrics.csv`), one record per line.
+
+    Memory stays the same however long the run: only the last `window` episodes are
+    kept. Both files stay open and are flushed every `flush_every` records and at exit.
+    The moving averages are also plotted in the background at most every `plot_every`
+    seconds (None turns plotting off). Episodes logged with a `level` are also averaged
+    per level; pass the `levels` up front to give them fixed CSV columns.
+    """
+
+    def __init__(
+        self,
+        save_dir,
+        timer=None,
+        structured="jsonl",
+        window=100,
+        flush_every=5,
+        plot_every=60.0,
+        levels=(),
+        prefetcher=None,
+    ):
         self.save_log = save_dir / "log"
-        with open(self.save_log, "w") as f:
-            f.write(
+        # With a timer, records also break the interval down by phase
+        self.timer = timer
+        # With a BatchPrefetcher, records also report its queue depth and the learner's wait
+        self.prefetcher = prefetcher
+        new_log = not self.save_log.exists()  # resumed runs keep appending to their log
+        self.log_file = open(self.save_log, "a", buffering=1 << 16)
+        if new_log:
+            self.log_file.write(
                 f"{'Episode':>8}{'Step':>8}{'Epsilon':>10}{'MeanReward':>15}"
                 f"{'MeanLength':>15}{'MeanLoss':>15}{'MeanQValue':>15}"
-                f"{'TimeDelta':>15}{'Time':>20}\n"
+                f"{'TimeDelta':>15}{'Time':>20}"
             )
+            if self.timer is not None:
+                phases = LOOP_PHASES + LEARN_PHASES
+                self.log_file.write(f"{'StepsPerSec':>12}{'UpdatesPerSec':>14}")
+                self.log_file.write("".join(f"{name.capitalize():>10}" for name in phases))
+            self.log_file.write("\n")
+
+        self.structured = structured
+        self.save_metrics = None
+        self.metrics_file = None
+        self.csv_writer = None
+        if structured is not None:
+            if structured not in ("jsonl", "csv"):
+                raise ValueError(f"Unknown structured format {structured!r}, expected jsonl/csv")
+            self.save_metrics = save_dir / f"metrics.{structured}"
+            self.metrics_file = open(self.save_metrics, "a", buffering=1 << 16, newline="")
+        self.flush_every = flush_every
+        self.records = 0
+
         self.ep_rewards_plot = save_dir / "reward_plot.jpg"
         self.ep_lengths_plot = save_dir / "length_plot.jpg"
         self.ep_avg_losses_plot = save_dir / "loss_plot.jpg"
         self.ep_avg_qs_plot = save_dir / "q_plot.jpg"
+        self.plotter = None
+        if plot_every is not None:
+            self.plotter = PlotRenderer(
+                {
+                    "mean_reward": (self.ep_rewards_plot, "Mean Reward"),
+                    "mean_length": (self.ep_lengths_plot, "Mean Length"),
+                    "mean_loss": (self.ep_avg_losses_plot, "Mean Loss"),
+                    "mean_q": (self.ep_avg_qs_plot, "Mean Q Value"),
+                },
+                refresh_every=plot_every,
+            )
+        atexit.register(self.close)
 
-        # History metrics
-        self.ep_rewards = []
-        self.ep_lengths = []
-        self.ep_avg_losses = []
-        self.ep_avg_qs = []
-
-        # Moving averages, added for every call to record()
-        self.moving_avg_ep_rewards = []
-        self.moving_avg_ep_lengths = []
-        self.moving_avg_ep_avg_losses = []
-        self.moving_avg_ep_avg_qs = []
+        # Moving averages over the last `window` episodes
+        self.ep_rewards = RollingMean(window)
+        self.ep_lengths = RollingMean(window)
+        self.ep_avg_losses = RollingMean(window)
+        self.ep_avg_qs = RollingMean(window)
+        self.window = window
+        self.level_stats = {level: LevelStats(window) for level in levels}
 
         # Current episode metric
         self.init_episode()
 
         # Timing
         self.record_time = time.time()
+        self.record_step = None
 
     def log_step(self, reward, loss, q):
         self.curr_ep_reward += reward
@@ -44,18 +215,24 @@ class MetricLogger:
             self.curr_ep_q += q
             self.curr_ep_loss_length += 1
 
-    def log_episode(self):
-        "Mark end of episode"
-        self.ep_rewards.append(self.curr_ep_reward)
-        self.ep_lengths.append(self.curr_ep_length)
+    def log_episode(self, reward=None, length=None, level=None, cleared=False):
+        "Mark end of episode; vectorized runs pass the finished episode's own reward and length"
+        reward = self.curr_ep_reward if reward is None else reward
+        length = self.curr_ep_length if length is None else length
+        self.ep_rewards.add(reward)
+        self.ep_lengths.add(length)
+        if level is not None:
+            if level not in self.level_stats:
+                self.level_stats[level] = LevelStats(self.window)
+            self.level_stats[level].add(reward, length, cleared)
         if self.curr_ep_loss_length == 0:
             ep_avg_loss = 0
             ep_avg_q = 0
         else:
             ep_avg_loss = np.round(self.curr_ep_loss / self.curr_ep_loss_length, 5)
             ep_avg_q = np.round(self.curr_ep_q / self.curr_ep_loss_length, 5)
-        self.ep_avg_losses.append(ep_avg_loss)
-        self.ep_avg_qs.append(ep_avg_q)
+        self.ep_avg_losses.add(ep_avg_loss)
+        self.ep_avg_qs.add(ep_avg_q)
 
         self.init_episode()
 
@@ -67,18 +244,15 @@ class MetricLogger:
         self.curr_ep_loss_length = 0
 
     def record(self, episode, epsilon, step):
-        mean_ep_reward = np.round(np.mean(self.ep_rewards[-100:]), 3)
-        mean_ep_length = np.round(np.mean(self.ep_lengths[-100:]), 3)
-        mean_ep_loss = np.round(np.mean(self.ep_avg_losses[-100:]), 3)
-        mean_ep_q = np.round(np.mean(self.ep_avg_qs[-100:]), 3)
-        self.moving_avg_ep_rewards.append(mean_ep_reward)
-        self.moving_avg_ep_lengths.append(mean_ep_length)
-        self.moving_avg_ep_avg_losses.append(mean_ep_loss)
-        self.moving_avg_ep_avg_qs.append(mean_ep_q)
+        mean_ep_reward = np.round(self.ep_rewards.mean, 3)
+        mean_ep_length = np.round(self.ep_lengths.mean, 3)
+        mean_ep_loss = np.round(self.ep_avg_losses.mean, 3)
+        mean_ep_q = np.round(self.ep_avg_qs.mean, 3)
 
         last_record_time = self.record_time
         self.record_time = time.time()
         time_since_last_record = np.round(self.record_time - last_record_time, 3)
+        now = datetime.datetime.now().strftime("%Y-%m-%dT%H:%M:%S")
 
         print(
             f"Episode {episode} - "
@@ -89,13 +263,121 @@ class MetricLogger:
             f"Mean Loss {mean_ep_loss} - "
             f"Mean Q Value {mean_ep_q} - "
             f"Time Delta {time_since_last_record} - "
-            f"Time {datetime.datetime.now().strftime('%Y-%m-%dT%H:%M:%S')}"
+            f"Time {now}"
+        )
+
+        row = dict(
+            episode=int(episode),
+            step=int(step),
+            epsilon=float(epsilon),
+            mean_reward=float(mean_ep_reward),
+            mean_length=float(mean_ep_length),
+            mean_loss=float(mean_ep_loss),
+            mean_q=float(mean_ep_q),
+            time_delta=float(time_since_last_record),
+            time=now,
+        )
+        timing = ""
+        if self.timer is not None:
+            timing_row = self.record_timing(step, self.record_time - last_record_time)
+            timing = f"{timing_row['steps_per_sec']:12.1f}{timing_row['updates_per_sec']:14.2f}"
+            timing += "".join(f"{timing_row[name]:10.3f}" for name in LOOP_PHASES + LEARN_PHASES)
+            row.update(timing_row)
+        if self.level_stats:
+            row.update(self.record_levels())
+        if self.prefetcher is not None:
+            row.update(self.record_prefetch())
+
+        self.log_file.write(
+            f"{episode:8d}{step:8d}{epsilon:10.3f}"
+            f"{mean_ep_reward:15.3f}{mean_ep_length:15.3f}{mean_ep_loss:15.3f}{mean_ep_q:15.3f}"
+            f"{time_since_last_record:15.3f}"
+            f"{now:>20}"
+            f"{timing}\n"
         )
+        self.write_structured(row)
+        if self.plotter is not None:
+            self.plotter.push(row)
 
-        with open(self.save_log, "a") as f:
-            f.write(
-                f"{episode:8d}{step:8d}{epsilon:10.3f}"
-                f"{mean_ep_reward:15.3f}{mean_ep_length:15.3f}{mean_ep_loss:15.3f}{mean_ep_q:15.3f}"
-                f"{time_since_last_record:15.3f}"
-                f"{datetime.datetime.now().strftime('%Y-%m-%dT%H:%M:%S'):>20}\n"
+        self.records += 1
+        if self.records % self.flush_every == 0:
+            self.flush()
+
+    def write_structured(self, row):
+        if self.structured == "jsonl":
+            self.metrics_file.write(json.dumps(row) + "\n")
+        elif self.structured == "csv":
+            if self.csv_writer is None:
+                self.csv_writer = csv.DictWriter(self.metrics_file, fieldnames=list(row))
+                if self.metrics_file.tell() == 0:
+                    self.csv_writer.writeheader()
+            self.csv_writer.writerow(row)
+
+    def record_timing(self, step, elapsed):
+        """Print where the interval went and return it as record fields"""
+        seconds, counts = self.timer.pop()
+        last_step, self.record_step = self.record_step, step
+        steps_per_sec = (step - last_step) / elapsed if last_step is not None and elapsed else 0.0
+        # One optimizer step per update
+        updates_per_sec = counts.get("optimizer", 0) / elapsed if elapsed else 0.0
+
+        breakdown = " - ".join(
+            f"{name} {seconds[name]:.2f}s ({seconds[name] / elapsed:.0%})"
+            for name in LOOP_PHASES + LEARN_PHASES
+            if name in seconds and elapsed
+        )
+        print(f"Steps/s {steps_per_sec:.1f} - Updates/s {updates_per_sec:.1f} - {breakdown}")
+
+        row = dict(steps_per_sec=steps_per_sec, updates_per_sec=updates_per_sec)
+        row.update((name, seconds.get(name, 0.0)) for name in LOOP_PHASES + LEARN_PHASES)
+        return row
+
+    def record_levels(self):
+        """Print the per-level averages and return them as record fields"""
+        row = {}
+        for level, stats in self.level_stats.items():
+            row[f"{level}_episodes"] = stats.episodes
+            if stats.episodes == 0:
+                # No finished episode yet: null rather than NaN, which strict JSON rejects
+                print(f"Level {level} - Episodes 0")
+                for name in ("mean_reward", "mean_length", "clear_rate"):
+                    row[f"{level}_{name}"] = None
+                continue
+            mean_reward = np.round(stats.rewards.mean, 3)
+            mean_length = np.round(stats.lengths.mean, 3)
+            print(
+                f"Level {level} - "
+                f"Episodes {stats.episodes} - "
+                f"Mean Reward {mean_reward} - "
+                f"Mean Length {mean_length} - "
+                f"Clear Rate {stats.clear_rate:.2f}"
             )
+            row[f"{level}_mean_reward"] = float(mean_reward)
+            row[f"{level}_mean_length"] = float(mean_length)
+            row[f"{level}_clear_rate"] = float(stats.clear_rate)
+        return row
+
+    def record_prefetch(self):
+        """Print how full the prefetch queue was and how long update() waited on it"""
+        stats = self.prefetcher.stats()
+        print(
+            f"Prefetch - Batches {stats['batches']} - "
+            f"Mean Queue Depth {stats['queue_depth']:.2f} - "
+            f"Wait {stats['wait']:.3f}s - "
+            f"Stalls {stats['stalls']} - "
+            f"Stale Priorities {stats['stale_priorities']}"
+        )
+        return {f"prefetch_{name}": value for name, value in stats.items()}
+
+    def flush(self):
+        self.log_file.flush()
+        if self.metrics_file is not None:
+            self.metrics_file.flush()
+
+    def close(self):
+        if self.plotter is not None:
+            self.plotter.close()
+        if not self.log_file.closed:
+            self.log_file.close()
+        if self.metrics_file is not None and not self.metrics_file.closed:
+            self.metrics_file.close()
@@ -1,5 +1,7 @@
 import copy
+import warnings
 
+import torch
 from torch import nn
 
 
@@ -23,9 +25,121 @@ class MarioNet(nn.Module):
         for p in self.target.parameters():
             p.requires_grad = False
 
+    @staticmethod
+    def preprocess(input):
+        """Scale uint8 frames to [0, 1] floats, on the whole batch at once"""
+        if input.dtype == torch.uint8:
+            return input.float().div_(255)
+        return input
+
     def forward(self, input, model):
-        input = input.to(self.device)
+        input = self.preprocess(input.to(self.device))
         if model == "online":
             return self.online(input)
         elif model == "target":
             return self.target(input)
+
+
+class GreedyPolicy(nn.Module):
+    """Preprocessing, a Q network and the argmax in one module, to trace or compile"""
+
+    def __init__(self, net):
+        super().__init__()
+        self.net = net
+
+    def forward(self, input):
+        return self.net(MarioNet.preprocess(input)).argmax(1)
+
+
+class CompiledPolicy:
+    """
+    Greedy actions of the online network through a compiled module, for act().
+
+    `mode="trace"` traces a copy with TorchScript, freezes it and optimizes it for
+    inference. Freezing folds the weights into the graph, so the module is rebuilt
+    once `rebuild_every` weight updates have been reported with `updated()`, or after
+    `invalidate()`. `mode="compile"` uses `torch.compile`, which reads the live
+    weights and never needs a rebuild, but takes a while to compile the first time.
+    One module is built per input dtype and shape.
+    """
+
+    modes = ("trace", "compile")
+
+    def __init__(self, online, mode="trace", rebuild_every=100):
+        if mode not in self.modes:
+            raise ValueError(f"Unknown compile mode {mode!r}, expected one of {self.modes}")
+        if mode == "compile" and not hasattr(torch, "compile"):
+            print("torch.compile is not available, tracing instead")
+            mode = "trace"
+        self.online = online
+        self.mode = mode
+        self.rebuild_every = rebuild_every
+        self.modules = {}
+        self.updates = 0  # weight updates since the modules were built
+
+    def updated(self, n=1):
+        self.updates += n
+        if self.mode == "trace" and self.updates >= self.rebuild_every:
+            self.invalidate()
+
+    def invalidate(self):
+        self.modules.clear()
+        self.updates = 0
+
+    def build(self, example):
+        if self.mode == "compile":
+            return torch.compile(GreedyPolicy(self.online))
+        policy = GreedyPolicy(copy.deepcopy(self.online)).eval()
+        with torch.no_grad(), warnings.catch_warnings():
+            warnings.simplefilter("ignore")  # optimize_for_inference warns it is deprecated
+            traced = torch.jit.trace(policy, example)
+            return torch.jit.optimize_for_inference(torch.jit.freeze(traced))
+
+    @torch.no_grad()
+    def __call__(self, input):
+        """Greedy action of each state in the batch `input`"""
+        key = (input.dtype, tuple(input.shape))
+        if key not in self.modules:
+            self.modules[key] = self.build(input)
+        return self.modules[key](input)
+
+
+class TargetUpdate:
+    """
+    Move Q_target toward Q_online in place.
+
+    `tau=1` copies Q_online (a hard update); `tau < 1` is a Polyak update,
+    target = target + tau * (online - target). The parameters are paired once, so a
+    call is a single fused `torch._foreach_*` op over all of them instead of building
+    and loading a state dict. Buffers, if any, are always copied. Torch versions
+    without `_foreach_copy_` or `_foreach_lerp_` fall back to per-tensor ops.
+    """
+
+    def __init__(self, online, target):
+        self.online = list(online.parameters())
+        self.target = list(target.parameters())
+        self.online_buffers = list(online.buffers())
+        self.target_buffers = list(target.buffers())
+        for a, b in zip(self.online + self.online_buffers, self.target + self.target_buffers):
+            if a.shape != b.shape:
+                raise ValueError(f"Q_online and Q_target differ: {a.shape} vs {b.shape}")
+
+    @staticmethod
+    def copy(targets, sources):
+        if hasattr(torch, "_foreach_copy_"):
+            torch._foreach_copy_(targets, sources)
+        else:
+            for target, source in zip(targets, sources):
+                target.copy_(source)
+
+    @torch.no_grad()
+    def __call__(self, tau=1.0):
+        if tau >= 1.0:
+            self.copy(self.target, self.online)
+        elif hasattr(torch, "_foreach_lerp_"):
+            torch._foreach_lerp_(self.target, self.online, tau)
+        else:
+            torch._foreach_mul_(self.target, 1.0 - tau)
+            torch._foreach_add_(self.target, self.online, alpha=tau)
+        if self.target_buffers:
+            self.copy(self.target_buffers, self.online_buffers)
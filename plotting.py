@@ -0,0 +1,146 @@
+import importlib.util
+import multiprocessing as mp
+import os
+import queue
+import time
+
+import numpy as np
+
+
+def minmax(x, y, max_points):
+    """Keep the lowest and highest point of each of `max_points // 2` equal-count buckets"""
+    n = len(x)
+    if n <= max_points:
+        return x, y
+    buckets = max_points // 2
+    edges = np.linspace(0, n, buckets + 1).astype(np.int64)
+    idx = []
+    for start, stop in zip(edges[:-1], edges[1:]):
+        low, high = start + np.argmin(y[start:stop]), start + np.argmax(y[start:stop])
+        idx.extend(sorted((low, high)))
+    idx = np.unique(idx)
+    return x[idx], y[idx]
+
+
+def lttb(x, y, max_points):
+    """
+    Largest-Triangle-Three-Buckets: keep the first and last point and, from each bucket
+    in between, the point forming the largest triangle with the point kept before it
+    and the mean of the next bucket.
+    """
+    n = len(x)
+    if n <= max_points or max_points < 3:
+        return x, y
+    edges = np.linspace(1, n - 1, max_points - 1).astype(np.int64)
+    idx = np.empty(max_points, dtype=np.int64)
+    idx[0], idx[-1] = 0, n - 1
+    a = 0
+    for i in range(max_points - 2):
+        start, stop = edges[i], edges[i + 1]
+        next_stop = edges[i + 2] if i + 2 < len(edges) else n
+        mean_x, mean_y = x[stop:next_stop].mean(), y[stop:next_stop].mean()
+        areas = np.abs(
+            (x[a] - mean_x) * (y[start:stop] - y[a]) - (x[a] - x[start:stop]) * (mean_y - y[a])
+        )
+        a = start + int(np.argmax(areas))
+        idx[i + 1] = a
+    return x[idx], y[idx]
+
+
+DOWNSAMPLERS = {"lttb": lttb, "minmax": minmax}
+
+
+def render(path, x, y, label, max_points, method):
+    """Plot `y` over `x` downsampled to `max_points`, replacing `path` atomically"""
+    import matplotlib
+
+    matplotlib.use("Agg")
+    import matplotlib.pyplot as plt
+
+    x, y = DOWNSAMPLERS[method](np.asarray(x, dtype=np.float64), np.asarray(y), max_points)
+    fig, ax = plt.subplots()
+    ax.plot(x, y)
+    ax.set_xlabel("Episode")
+    ax.set_ylabel(label)
+    tmp_path = path.with_name(path.name + ".tmp")
+    fig.savefig(tmp_path, format=path.suffix.lstrip(".") or "png")
+    plt.close(fig)
+    os.replace(tmp_path, path)
+
+
+def _worker(rows, plots, refresh_every, max_points, method):
+    """Collect records from `rows` and redraw `plots` at most every `refresh_every` seconds"""
+    episodes = []
+    series = {key: [] for key in plots}
+    last_render, dirty = 0.0, False
+    while True:
+        try:
+            row = rows.get(timeout=max(0.1, refresh_every - (time.time() - last_render)))
+        except queue.Empty:
+            row = False
+        if row is None:  # closing: one last render with everything received
+            break
+        if row:
+            episodes.append(row["episode"])
+            for key in plots:
+                series[key].append(row[key])
+            dirty = True
+        if dirty and time.time() - last_render >= refresh_every:
+            for key, (path, label) in plots.items():
+                render(path, episodes, series[key], label, max_points, method)
+            last_render, dirty = time.time(), False
+    if dirty:
+        for key, (path, label) in plots.items():
+            render(path, episodes, series[key], label, max_points, method)
+
+
+class PlotRenderer:
+    """
+    Draw metric curves in a background process.
+
+    `push(row)` only puts the record on a queue and drops it if the queue is full, so
+    the training loop never waits on matplotlib. The worker redraws at most every
+    `refresh_every` seconds, downsampling each curve to `max_points` with LTTB or
+    min-max so drawing takes the same time however long the run. Without matplotlib
+    installed, plotting is skipped.
+
+    `plots` maps a record key to (path, y label).
+    """
+
+    def __init__(self, plots, refresh_every=60.0, max_points=2000, method="lttb", maxsize=10000):
+        if method not in DOWNSAMPLERS:
+            raise ValueError(f"Unknown downsampling {method!r}, expected {list(DOWNSAMPLERS)}")
+        self.dropped = 0
+        self.enabled = importlib.util.find_spec("matplotlib") is not None
+        if not self.enabled:
+            print("matplotlib is not installed, metric plots are disabled")
+            return
+        ctx = mp.get_context()
+        self.rows = ctx.Queue(maxsize=maxsize)
+        self.process = ctx.Process(
+            target=_worker,
+            args=(self.rows, plots, refresh_every, max_points, method),
+            name="plot-renderer",
+            daemon=True,
+        )
+        self.process.start()
+
+    def push(self, row):
+        if not self.enabled:
+            return
+        try:
+            self.rows.put_nowait(row)
+        except queue.Full:
+            self.dropped += 1
+
+    def close(self, timeout=30.0):
+        """Let the worker draw what it has received, waiting at most `timeout` seconds"""
+        if not self.enabled or not self.process.is_alive():
+            return
+        try:
+            self.rows.put(None, timeout=timeout)
+        except queue.Full:
+            pass
+        self.process.join(timeout)
+        if self.process.is_alive():
+            self.process.terminate()
@@ -2,16 +2,21 @@ from pathlib import Path
 
 from agent import Mario
 from env import build_env
+from export import load_policy
 
 env = build_env()
 
 checkpoint = Path("checkpoints/trained_mario.chkpt")
-mario = Mario(
-    state_dim=(4, 21, 21),
-    action_dim=env.action_space.n,
-    checkpoint=checkpoint,
-)
-mario.exploration_rate = mario.exploration_rate_min
+policy_path = None  # an export.py artifact, e.g. checkpoints/trained_mario.int8.pt
+if policy_path is not None:
+    mario = load_policy(policy_path, exploration_rate=0.1)
+else:
+    mario = Mario(
+        state_dim=(4, 21, 21),
+        action_dim=env.action_space.n,
+        checkpoint=checkpoint,
+    )
+    mario.exploration_rate = mario.exploration_rate_min
 
 episodes = 40000
 total_reward = 0.0
@@ -23,7 +28,8 @@ for e in range(episodes):
         action = mario.act(state)
         next_state, reward, done, info = env.step(action)
         total_reward += reward
-        mario.cache(state, next_state, action, reward, done)
+        if isinstance(mario, Mario):
+            mario.cache(state, next_state, action, reward, done)
         state = next_state
         if done or info["flag_get"]:
             break
@@ -17,9 +17,12 @@ except ImportError:
 
 # --- 設定要載入的已訓練模型路徑 ---
 CHECKPOINT_PATH = Path(r'checkpoints\mario_net_7.chkpt') # <--- 修改為您的新模型路徑
+# 可選: export.py 匯出的 int8 策略 (例如 checkpoints\mario_net_7.int8.pt)，設定後就不需要 checkpoint
+POLICY_PATH = None
 
-if not CHECKPOINT_PATH.exists():
-    print(f"錯誤: 找不到指定的模型檔案: {CHECKPOINT_PATH}")
+MODEL_PATH = Path(POLICY_PATH) if POLICY_PATH else CHECKPOINT_PATH
+if not MODEL_PATH.exists():
+    print(f"錯誤: 找不到指定的模型檔案: {MODEL_PATH}")
     exit()
 
 # --- 環境初始化 ---
@@ -29,14 +32,19 @@ print("環境建立完成。")
 # --- 環境初始化結束 ---
 
 # --- AI Agent 初始化 ---
-mario_agent = Mario(
-    state_dim=(4, 21, 21),
-    action_dim=env.action_space.n,
-    save_dir=None,
-    checkpoint=CHECKPOINT_PATH
-)
+if POLICY_PATH:
+    from export import load_policy
+
+    mario_agent = load_policy(MODEL_PATH, exploration_rate=0.0)
+else:
+    mario_agent = Mario(
+        state_dim=(4, 21, 21),
+        action_dim=env.action_space.n,
+        save_dir=None,
+        checkpoint=CHECKPOINT_PATH
+    )
 mario_agent.exploration_rate = 0.0
-print(f"已載入模型: {CHECKPOINT_PATH}")
+print(f"已載入模型: {MODEL_PATH}")
 print(f"AI 探索率設定為: {mario_agent.exploration_rate}")
 print(f"環境動作空間大小: {env.action_space.n}")
 
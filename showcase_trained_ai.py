@@ -17,9 +17,12 @@ from wrappers import CutAndScaleObservation, SkipFrame # ResizeObservation 可
 # --- 設定要載入的已訓練模型路徑 ---
 CHECKPOINT_PATH = Path('checkpoints\mario_net_7.chkpt'
 '') # <--- 確保這是你正確的模型路徑
+# 可選: export.py 匯出的 int8 策略，設定後就不需要 checkpoint
+POLICY_PATH = None
 
-if not CHECKPOINT_PATH.exists():
-    print(f"錯誤: 找不到指定的模型檔案: {CHECKPOINT_PATH}")
+MODEL_PATH = Path(POLICY_PATH) if POLICY_PATH else CHECKPOINT_PATH
+if not MODEL_PATH.exists():
+    print(f"錯誤: 找不到指定的模型檔案: {MODEL_PATH}")
     exit()
 
 # --- 環境初始化 (完全依照 env.py 中的 build_env() 邏輯) ---
@@ -38,9 +41,13 @@ print("環境建立完成。")
 
 # --- AI Agent 初始化 ---
 # state_dim 應匹配 FrameStack 的輸出 (4, 21, 21)
-mario = Mario(state_dim=(4, 21, 21), action_dim=env.action_space.n, save_dir=None, checkpoint=CHECKPOINT_PATH)
+if POLICY_PATH:
+    from export import load_policy
+    mario = load_policy(MODEL_PATH)
+else:
+    mario = Mario(state_dim=(4, 21, 21), action_dim=env.action_space.n, save_dir=None, checkpoint=CHECKPOINT_PATH)
 mario.exploration_rate = 0.0 # 總是利用學到的策略
-print(f"已載入模型: {CHECKPOINT_PATH}")
+print(f"已載入模型: {MODEL_PATH}")
 print(f"AI 探索率設定為: {mario.exploration_rate}")
 
 # --- 展示設定 (與之前相同，只顯示成功過關的回合) ---
@@ -1,38 +1,225 @@
+import argparse
 import datetime
+from functools import partial
 from pathlib import Path
 
+import numpy as np
+
 from agent import Mario
+from checkpoint import latest_checkpoint
+from curriculum import find_curriculum
 from env import build_env
-from metrics import MetricLogger
+from levels import LEVEL_POLICIES, LevelScheduler, parse_levels
+from memory import REPLAY_BUFFERS
+from metrics import MetricLogger, PhaseTimer
+from vec_env import SubprocVecEnv
+
+
+def train(env, mario, logger, episodes):
+    # One curriculum per level when scheduling several, keyed by level; else at most one
+    if isinstance(env, LevelScheduler):
+        curricula = env.curricula()
+    else:
+        curricula = {None: find_curriculum(env)} if find_curriculum(env) is not None else {}
+    timer = mario.timer
+    for e in range(episodes):
+        state = env.reset()
+        while True:
+            with timer.phase("act"):
+                action = mario.act(state)
+            with timer.phase("env"):
+                next_state, reward, done, info = env.step(action)
+            with timer.phase("cache"):
+                mario.cache(state, next_state, action, reward, done)
+            with timer.phase("learn"):
+                q, loss = mario.learn()
+            with timer.phase("log"):
+                logger.log_step(reward, loss, q)
+            state = next_state
+            if done or info["flag_get"]:
+                break
+
+        logger.log_episode(level=info.get("level"), cleared=info["flag_get"])
+
+        if e % 20 == 0:
+            logger.record(episode=e, epsilon=mario.exploration_rate, step=mario.curr_step)
+            for level, curriculum in curricula.items():
+                stats = " - ".join(f"{k} {v:.4g}" for k, v in curriculum.stats().items())
+                print(f"Level {level} - {stats}" if level is not None else stats)
+
+
+def train_vectorized(env, mario, logger, episodes):
+    timer = mario.timer
+    e = 0
+    states = env.reset()
+    while e < episodes:
+        with timer.phase("act"):
+            actions = mario.act_batch(states)
+        with timer.phase("env"):
+            next_states, rewards, dones, infos = env.step(actions)
+        with timer.phase("cache"):
+            for i in range(env.num_envs):
+                next_state = infos[i]["terminal_observation"] if dones[i] else next_states[i]
+                mario.cache(states[i], next_state, actions[i], rewards[i], dones[i], stream=i)
+        with timer.phase("learn"):
+            q, loss = mario.learn()
+        with timer.phase("log"):
+            logger.log_step(0.0, loss, q)  # episode reward/length come from the workers
+        states = next_states
+
+        for info in infos:
+            if "episode" not in info:
+                continue
+            logger.log_episode(
+                reward=info["episode"]["r"],
+                length=info["episode"]["l"],
+                level=info.get("level"),
+                cleared=info.get("flag_get", False),
+            )
+            if e % 20 == 0:
+                logger.record(episode=e, epsilon=mario.exploration_rate, step=mario.curr_step)
+            e += 1
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Train Mario on SuperMarioBros-1-2")
+    parser.add_argument(
+        "--levels",
+        type=parse_levels,
+        default=None,
+        help="comma-separated levels to train on instead of 1-2, e.g. 1-1,1-2,4-1",
+    )
+    parser.add_argument(
+        "--level-policy",
+        default="round-robin",
+        choices=list(LEVEL_POLICIES),
+        help="how the next episode's level is picked",
+    )
+    parser.add_argument(
+        "--save-dir",
+        type=Path,
+        default=Path("checkpoints") / datetime.datetime.now().strftime("%Y-%m-%dT%H-%M-%S"),
+        help="run directory; pass an existing one to reopen its on-disk replay",
+    )
+    parser.add_argument(
+        "--resume", action="store_true", help="resume from the latest checkpoint in --save-dir"
+    )
+    parser.add_argument(
+        "--checkpoint-replay", action="store_true", help="include the replay in checkpoints"
+    )
+    parser.add_argument("--replay", default="frames", choices=list(REPLAY_BUFFERS))
+    parser.add_argument("--replay-capacity", type=int, default=1000000)
+    parser.add_argument("--prioritized", action="store_true", help="prioritized experience replay")
+    parser.add_argument(
+        "--num-envs", type=int, default=1, help="step this many envs in worker processes"
+    )
+    parser.add_argument(
+        "--fused", action="store_true", help="single-pass FusedObservation preprocessing"
+    )
+    parser.add_argument(
+        "--uint8", action="store_true", help="keep observations uint8, MarioNet scales them"
+    )
+    parser.add_argument(
+        "--curriculum",
+        type=float,
+        default=None,
+        metavar="FRACTION",
+        help="start this fraction of episodes from mid-level snapshots",
+    )
+    parser.add_argument(
+        "--n-steps", type=int, default=1, help="bootstrap from n-step returns"
+    )
+    parser.add_argument(
+        "--fused-update",
+        choices=["on", "off"],
+        default=None,
+        help="one Q_online forward over state and next_state; default: on with a GPU",
+    )
+    parser.add_argument(
+        "--mixed-precision",
+        choices=["learn", "all"],
+        default=None,
+        help="bfloat16 autocast for the forwards of learn() (all: also act()), float32 weights",
+    )
+    parser.add_argument(
+        "--tau",
+        type=float,
+        default=1.0,
+        help="if < 1, Polyak-average Q_target toward Q_online by tau after every update "
+        "instead of copying it every sync_every steps",
+    )
+    parser.add_argument(
+        "--compile-act",
+        choices=["trace", "compile"],
+        default=None,
+        help="choose greedy actions with a traced or torch.compile'd Q_online",
+    )
+    parser.add_argument(
+        "--compile-every", type=int, default=100, help="updates between rebuilds of a trace"
+    )
+    parser.add_argument(
+        "--prefetch",
+        type=int,
+        default=0,
+        metavar="DEPTH",
+        help="sample this many batches ahead in a background thread",
+    )
+    parser.add_argument(
+        "--timing-sample",
+        type=int,
+        default=1,
+        metavar="N",
+        help="time every N-th call of each phase, scaling up to all of them",
+    )
+    args = parser.parse_args()
 
-env = build_env()
+    env_fn = partial(build_env, fused=args.fused, uint8=args.uint8, curriculum=args.curriculum)
+    if args.levels:
+        # One env per level, built once; every worker of a vectorized run schedules its own
+        env_fn = partial(LevelScheduler, env_fn, args.levels, policy=args.level_policy)
+    if args.num_envs > 1:
+        obs_dtype = np.uint8 if args.uint8 else np.float32
+        env = SubprocVecEnv(env_fn, args.num_envs, obs_dtype=obs_dtype)
+    else:
+        env = env_fn()
 
-save_dir = Path("checkpoints") / datetime.datetime.now().strftime("%Y-%m-%dT%H-%M-%S")
-save_dir.mkdir(parents=True)
+    save_dir = args.save_dir
+    save_dir.mkdir(parents=True, exist_ok=True)
+    checkpoint = latest_checkpoint(save_dir) if args.resume else None
+    if args.resume and checkpoint is None:
+        raise ValueError(f"No checkpoint to resume from in {save_dir}")
 
-mario = Mario(
-    state_dim=(4, 21, 21),
-    action_dim=env.action_space.n,
-    save_dir=save_dir,
-)
+    mario = Mario(
+        state_dim=(4, 21, 21),
+        action_dim=env.action_space.n,
+        save_dir=save_dir,
+        replay=args.replay,
+        replay_capacity=args.replay_capacity,
+        prioritized=args.prioritized,
+        checkpoint=checkpoint,
+        checkpoint_replay=args.checkpoint_replay,
+        timer=PhaseTimer(sample_every=args.timing_sample),
+        n_steps=args.n_steps,
+        compile_act=args.compile_act,
+        compile_every=args.compile_every,
+        tau=args.tau,
+        mixed_precision=args.mixed_precision,
+        fused_update=None if args.fused_update is None else args.fused_update == "on",
+        prefetch=args.prefetch,
+    )
 
-logger = MetricLogger(save_dir)
+    logger = MetricLogger(
+        save_dir, timer=mario.timer, levels=args.levels or (), prefetcher=mario.prefetcher
+    )
 
-episodes = 200000
+    episodes = 200000
 
-for e in range(episodes):
-    state = env.reset()
-    while True:
-        action = mario.act(state)
-        next_state, reward, done, info = env.step(action)
-        mario.cache(state, next_state, action, reward, done)
-        q, loss = mario.learn()
-        logger.log_step(reward, loss, q)
-        state = next_state
-        if done or info["flag_get"]:
-            break
+    if args.num_envs > 1:
+        train_vectorized(env, mario, logger, episodes)
+        env.close()
+    else:
+        train(env, mario, logger, episodes)
 
-    logger.log_episode()
 
-    if e % 20 == 0:
-        logger.record(episode=e, epsilon=mario.exploration_rate, step=mario.curr_step)
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,140 @@
+import ctypes
+import multiprocessing as mp
+
+import numpy as np
+
+
+def _worker(index, env_fn, remote, parent_remote, obs_buffer, obs_shape, obs_dtype):
+    """
+    Run one environment, writing observations straight into its row of the shared
+    buffer and sending only reward/done/info back through the pipe.
+    """
+    parent_remote.close()
+    obs = np.frombuffer(obs_buffer, dtype=obs_dtype).reshape(-1, *obs_shape)[index]
+    env = env_fn()
+    episode_reward = 0.0
+    episode_length = 0
+    try:
+        while True:
+            command, action = remote.recv()
+            if command == "step":
+                next_obs, reward, done, info = env.step(action)
+                episode_reward += reward
+                episode_length += 1
+                done = done or info.get("flag_get", False)
+                if done:
+                    # The row is about to hold the first frame of the next episode
+                    info["terminal_observation"] = np.asarray(next_obs, dtype=obs_dtype)
+                    info["episode"] = {"r": episode_reward, "l": episode_length}
+                    episode_reward = 0.0
+                    episode_length = 0
+                    next_obs = env.reset()
+                obs[:] = next_obs
+                remote.send((reward, done, info))
+            elif command == "reset":
+                obs[:] = env.reset()
+                episode_reward = 0.0
+                episode_length = 0
+                remote.send(None)
+            elif command == "spaces":
+                remote.send((env.observation_space, env.action_space))
+            elif command == "close":
+                break
+            else:
+                raise ValueError(f"Unknown command {command!r}")
+    except KeyboardInterrupt:
+        pass
+    finally:
+        env.close()
+        remote.close()
+
+
+class SubprocVecEnv:
+    """
+    Step `num_envs` copies of an environment in worker processes.
+
+    Observations are written by the workers into one shared `(num_envs, *obs_shape)`
+    buffer, so a step only pickles rewards, dones and infos. Episodes that end,
+    by `done` or by `info["flag_get"]`, are reset automatically: the returned
+    observation is then the first one of the next episode, and the final one is in
+    `info["terminal_observation"]` together with `info["episode"]` holding the
+    episode reward `r` and length `l`.
+    """
+
+    def __init__(self, env_fn, num_envs, obs_shape=(4, 21, 21), obs_dtype=np.float32):
+        self.num_envs = num_envs
+        self.obs_shape = tuple(obs_shape)
+        self.obs_dtype = np.dtype(obs_dtype)
+
+        ctx = mp.get_context()
+        nbytes = num_envs * int(np.prod(self.obs_shape)) * self.obs_dtype.itemsize
+        self._obs_buffer = ctx.RawArray(ctypes.c_uint8, nbytes)
+        self._obs = np.frombuffer(self._obs_buffer, dtype=self.obs_dtype).reshape(
+            num_envs, *self.obs_shape
+        )
+
+        self.remotes, self.processes = [], []
+        for i in range(num_envs):
+            remote, work_remote = ctx.Pipe()
+            process = ctx.Process(
+                target=_worker,
+                args=(
+                    i,
+                    env_fn,
+                    work_remote,
+                    remote,
+                    self._obs_buffer,
+                    self.obs_shape,
+                    self.obs_dtype,
+                ),
+                daemon=True,
+            )
+            process.start()
+            work_remote.close()
+            self.remotes.append(remote)
+            self.processes.append(process)
+        self.closed = False
+
+        self.remotes[0].send(("spaces", None))
+        self.observation_space, self.action_space = self.remotes[0].recv()
+
+    def reset(self):
+        """
+        Outputs:
+        obs (np.ndarray): (num_envs, *obs_shape) first observations
+        """
+        for remote in self.remotes:
+            remote.send(("reset", None))
+        for remote in self.remotes:
+            remote.recv()
+        return self._obs.copy()
+
+    def step(self, actions):
+        """
+        Inputs:
+        actions (sequence of int): One action per environment
+        Outputs:
+        obs (np.ndarray): (num_envs, *obs_shape) next observations
+        rewards (np.ndarray): (num_envs,) float32 rewards
+        dones (np.ndarray): (num_envs,) bool, True where an episode ended
+        infos (list of dict): Per-environment info
+        """
+        for remote, action in zip(self.remotes, actions):
+            remote.send(("step", int(action)))
+        results = [remote.recv() for remote in self.remotes]
+        rewards, dones, infos = zip(*results)
+        return (
+            self._obs.copy(),
+            np.array(rewards, dtype=np.float32),
+            np.array(dones, dtype=np.bool_),
+            list(infos),
+        )
+
+    def close(self):
+        if self.closed:
+            return
+        for remote in self.remotes:
+            remote.send(("close", None))
+        for process in self.processes:
+            process.join()
+        self.closed = True
@@ -1,3 +1,6 @@
+from functools import lru_cache
+
+import cv2
 import gym
 import numpy as np
 
@@ -5,17 +8,137 @@ from gym.spaces import Box
 from skimage import transform
 
 
+@lru_cache(maxsize=None)
+def area_weights(in_size, out_size):
+    """(out_size, in_size) matrix averaging the input pixels each output pixel covers"""
+    edges = np.arange(out_size + 1) * in_size / out_size
+    pixels = np.arange(in_size)
+    overlap = np.minimum(edges[1:, None], pixels + 1) - np.maximum(edges[:-1, None], pixels)
+    return (np.clip(overlap, 0, None) * out_size / in_size).astype(np.float32)
+
+
+def resize_numpy(frames, shape):
+    """
+    Area-average (..., H, W) uint8 frames to (..., *shape) in NumPy.
+
+    Integer ratios are a reshape and mean over the blocks; other ratios apply the
+    separable area weights as two matrix products over the whole batch.
+    """
+    h, w = frames.shape[-2:]
+    out_h, out_w = shape
+    if h % out_h == 0 and w % out_w == 0:
+        blocks = frames.reshape(*frames.shape[:-2], out_h, h // out_h, out_w, w // out_w)
+        resized = blocks.mean(axis=(-3, -1), dtype=np.float32)
+    else:
+        resized = area_weights(h, out_h) @ frames.astype(np.float32) @ area_weights(w, out_w).T
+    return np.rint(resized).astype(np.uint8)
+
+
+def resize_cv2(frames, shape):
+    """Area-average (..., H, W) uint8 frames with cv2.INTER_AREA"""
+    flat = frames.reshape(-1, *frames.shape[-2:])
+    resized = [cv2.resize(frame, shape[::-1], interpolation=cv2.INTER_AREA) for frame in flat]
+    return np.stack(resized).reshape(*frames.shape[:-2], *shape)
+
+
+def resize_skimage(frames, shape, preserve_range=False):
+    """
+    The original float64 anti-aliased `skimage.transform.resize`, kept as the reference.
+    CutAndScaleObservation rescaled the [0, 1] output by 255, ResizeObservation used
+    `preserve_range=True`; both truncate to uint8, so each call is reproduced as it was.
+    """
+    flat = frames.reshape(-1, *frames.shape[-2:])
+    if preserve_range:
+        resized = [
+            transform.resize(frame, shape, preserve_range=True, anti_aliasing=True).astype(np.uint8)
+            for frame in flat
+        ]
+    else:
+        resized = [(transform.resize(frame, shape) * 255).astype(np.uint8) for frame in flat]
+    return np.stack(resized).reshape(*frames.shape[:-2], *shape)
+
+
+RESIZE_BACKENDS = {
+    "numpy": resize_numpy,
+    "cv2": resize_cv2,
+    "skimage": resize_skimage,
+}
+
+
+def resize(frames, shape, backend="skimage", preserve_range=False):
+    """
+    Resize a uint8 frame or a batch of frames, (..., H, W), with the given backend.
+    `preserve_range` selects which original skimage call the "skimage" backend
+    reproduces, see `resize_skimage`; the other backends round and ignore it.
+    """
+    if backend not in RESIZE_BACKENDS:
+        raise ValueError(f"Unknown resize backend {backend!r}, expected one of {list(RESIZE_BACKENDS)}")
+    if backend == "skimage":
+        return resize_skimage(np.asarray(frames), tuple(shape), preserve_range)
+    return RESIZE_BACKENDS[backend](np.asarray(frames), tuple(shape))
+
+
 class CutAndScaleObservation(gym.ObservationWrapper):
-    def __init__(self, env):
+    def __init__(self, env, backend="skimage"):
         super().__init__(env)
         self.shape = (21, 21)
+        self.backend = backend
         self.observation_space = Box(low=0, high=255, shape=self.shape, dtype=np.uint8)
 
     def observation(self, observation):
-        resize_obs = transform.resize(observation[120:, 128:], (21, 21))
-        resize_obs *= 255
-        resize_obs = resize_obs.astype(np.uint8)
-        return resize_obs
+        return resize(observation[..., 120:, 128:], self.shape, self.backend)
+
+
+class FusedObservation(gym.Wrapper):
+    """
+    Replace GrayScaleObservation, CutAndScaleObservation, TransformObservation and
+    FrameStack with a single pass per step.
+
+    Only the bottom-right crop of the RGB frame is converted to gray, it is
+    area-downsampled straight to `shape` in uint8 and written into a rolling uint8
+    stack. Area averaging differs slightly from the anti-aliased bilinear
+    `skimage.transform.resize` of CutAndScaleObservation, by a few gray levels on
+    average; `backend="skimage"` reproduces it exactly.
+    """
+
+    def __init__(
+        self, env, num_stack=4, shape=(21, 21), crop=(120, 128), scale=True, backend="cv2"
+    ):
+        super().__init__(env)
+        self.num_stack = num_stack
+        self.shape = tuple(shape)
+        self.crop = crop
+        self.backend = backend
+        self.scale = scale  # output float32 in [0, 1] like x / 255.0, else raw uint8
+        self.frames = np.zeros((num_stack, *self.shape), dtype=np.uint8)
+        if scale:
+            self.observation_space = Box(
+                low=0.0, high=1.0, shape=self.frames.shape, dtype=np.float32
+            )
+        else:
+            self.observation_space = Box(low=0, high=255, shape=self.frames.shape, dtype=np.uint8)
+
+    def process(self, observation):
+        top, left = self.crop
+        gray = cv2.cvtColor(observation[top:, left:], cv2.COLOR_RGB2GRAY)
+        return resize(gray, self.shape, self.backend)
+
+    def stacked(self):
+        if self.scale:
+            return self.frames.astype(np.float32) / 255.0
+        return self.frames.copy()
+
+    def reset(self, **kwargs):
+        reset_output = self.env.reset(**kwargs)
+        obs, info = reset_output if isinstance(reset_output, tuple) else (reset_output, None)
+        self.frames[:] = self.process(obs)  # pad with the first frame, like FrameStack
+        return self.stacked() if info is None else (self.stacked(), info)
+
+    def step(self, action):
+        obs, reward, done, info = self.env.step(action)
+        self.frames[:-1] = self.frames[1:]
+        self.frames[-1] = self.process(obs)
+        return self.stacked(), reward, done, info
 
 
 class SkipFrame(gym.Wrapper):
@@ -38,8 +161,9 @@ class SkipFrame(gym.Wrapper):
 
 
 class ResizeObservation(gym.ObservationWrapper):
-    def __init__(self, env, shape):
+    def __init__(self, env, shape, backend="skimage"):
         super().__init__(env)
+        self.backend = backend
         if isinstance(shape, int):
             self.shape = (shape, shape)
         else:
@@ -52,19 +176,10 @@ class ResizeObservation(gym.ObservationWrapper):
         self.observation_space = Box(low=0, high=255, shape=self.shape, dtype=np.uint8)
 
     def observation(self, observation):
-        # transform.resize 預設會將輸出值縮放到 [0, 1] 浮點數 (如果 preserve_range=False)
-        # 但因為後續有 x / 255. 的操作，這裡 ResizeObservation 應該輸出 uint8 [0, 255]
-        # 因此使用 preserve_range=True，並確保輸入是 uint8
-        # 或者，如果輸入是 [0,1] float，則 resize 後乘以 255
-        
         # 假設輸入的 observation 是 uint8 類型且範圍是 [0, 255] (例如來自 GrayScaleObservation)
-        resized_obs = transform.resize(
-            observation,
-            self.shape,
-            preserve_range=True, # 保持原始值的範圍
-            anti_aliasing=True   # 建議開啟以獲得更好的縮放品質
-        )
-        return resized_obs.astype(np.uint8)
+        # backend 預設為 "skimage"，即原本的 transform.resize(preserve_range=True, anti_aliasing=True)
+        # 也可改用 "numpy" 或 "cv2"
+        return resize(observation, self.shape, self.backend, preserve_range=True)
     
 class CustomRewardMario(gym.Wrapper):
     def __init__(self, env):